@@ -1,81 +1,611 @@
 # coding=utf-8
+import array
 import collections
+import copy
+import random
+import re
 
 Vector = collections.namedtuple('Vector', ['dx', 'dy'])
 
 Square = collections.namedtuple('Square', ['x', 'y'])
 
+# 走法编码: 起点下标占低 12 位, 终点下标占随后 12 位, 标志位占最高 8 位(棋盘最多 4096 个格子)
+MOVE_SQUARE_BITS = 12
+MOVE_SQUARE_MASK = (1 << MOVE_SQUARE_BITS) - 1
+MOVE_FLAG_CAPTURE = 1  # 终点有敌方单位
+MOVE_FLAG_PROMOTION = 2  # 兵到达底线升变
+
+
+def pack_move(from_index, to_index, flags=0):
+    return from_index | to_index << MOVE_SQUARE_BITS | flags << 2 * MOVE_SQUARE_BITS
+
+
+def unpack_move(move):
+    """把 pack_move() 的编码还原为 (起点下标, 终点下标, 标志位)"""
+    return move & MOVE_SQUARE_MASK, move >> MOVE_SQUARE_BITS & MOVE_SQUARE_MASK, move >> 2 * MOVE_SQUARE_BITS
+
+
+_zobrist_key_cache = {}
+
+
+def zobrist_keys(name, square_count):
+    """返回名为 name 的一组 64 位 Zobrist 随机数(每个格子一个)
+
+    随机数由名字确定性地生成, 同一局面在不同进程中得到相同的 Zobrist 键值.
+    """
+    try:
+        return _zobrist_key_cache[name, square_count]
+    except KeyError:
+        rng = random.Random(name)
+        keys = _zobrist_key_cache[name, square_count] = tuple(rng.getrandbits(64) for _ in range(square_count))
+        return keys
+
 
 class Unit(object):
+    __slots__ = ('owner', 'has_been_moved')
+
     def __init__(self, owner):
         self.owner = owner  
         self.has_been_moved = None  
 
+    def __copy__(self):
+        clone = type(self).__new__(type(self))
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, name):
+                    setattr(clone, name, getattr(self, name))
+        return clone
+
+
+# 玩家编码和单位编码的类型, 即 GameArena.PlayerID 和 GameArena.UnitID.
+# 定义在模块一级, Python 2 的 pickle 才能按名字找到它们(例如把 GameArena 发送给其他进程时)
+class PlayerID(int):
+    pass
 
-class GameArena:
-    
 
-    class PlayerID(int):
-        pass
+class UnitID(int):
+    pass
+
+
+class GameArena(object):
+    
 
-    class UnitID(int):
-        pass
+    PlayerID = PlayerID
+    UnitID = UnitID
 
     def __init__(self, width, ranks):
         
         self.__unit_info_list = []  # 按单位的编码顺序存储所有战斗单位的信息(其中并不包括该单位所在位置), 初始状态为空列表, 通过编码查找. 单位死亡后仍然保留记录
-        # 二维数组共 width*ranks 个格子, 记录每个空格被哪一个棋子占领, 全部初始化置零表示所有格子均无人占领:
-        self.__battlefield = [[self.UnitID(0)] * width for y in range(ranks)]
+        self.__width, self.__ranks = width, ranks
+        # 一维数组(mailbox)共 width*ranks 个格子, 按 x + y*width 的顺序记录每个空格被哪一个棋子占领, 全部初始化置零表示所有格子均无人占领:
+        self.__mailbox = [self.UnitID(0)] * (width * ranks)
+        # 与 mailbox 互为反向索引: 按单位的编码顺序记录其所在格子的下标, 不在棋盘上(未部署或已阵亡)时为 None
+        self.__unit_squares = []
+        # 位棋盘(bitboard): 第 x + y*width 位为 1 表示该格子被占领
+        self.__occupancy = 0
+        self.__owner_masks = {}  # PlayerID -> 该玩家所有单位占领的格子
+        self.__unit_type_masks = {}  # 单位类型(如 RookUnit) -> 该类型所有单位占领的格子
+        self.__nodes = [Snapshot.EMPTY_NODE]  # 按单位编码索引的 Snapshot.Node, 供所有快照共享
+        self.__version = 0  # 棋盘版本号, 每次有单位上场/移动/被吃都会加一
+        self.__snapshot = None  # 当前版本的快照, 按需创建
+        # 攻击范围: 按单位编码记录每个单位当前攻击范围的位棋盘(不在棋盘上时为 0), 每次走子后只重算受影响的单位
+        self.__unit_attacks = []
+        self.__attack_maps = {}  # PlayerID -> 该玩家所有单位攻击范围的并集, 按需重新合并
+        self.__stale_attack_maps = set()  # 攻击范围发生变化、尚未重新合并的玩家
+        self.__changed_squares = 0  # 自上次刷新攻击范围以来占领状态发生变化的格子
+        self.__undo_stack = []  # make_move() 的悔棋记录, 供 unmake_move() 按后进先出的顺序还原
+        self.__attack_journal = None  # make_move() 期间记录被改写的攻击范围: [(单位下标, 原攻击范围), ...]
+        self.__players = []  # 按第一次招募单位的顺序排列的玩家, 决定轮流走棋的顺序
+        self.__side_to_move = None  # 轮到哪一方走棋, 第一个招募单位的玩家先走
+        self.__zobrist_key = 0  # 当前局面的 Zobrist 键值, 随每次走子增量更新
+        # 写时复制: fork() 之后 mailbox 等列表和单位对象与其他 arena 共用, 第一次修改之前才复制
+        self.__shared_lists = False
+        self.__shared_units = 0  # 第 unit_id 位为 1 表示该单位与其他 arena 共用, 修改状态之前需要先复制
+        # 走法缓存: 单位编码 -> [走法位棋盘, Square 元组或 None], 只对版本号为 __move_cache_version 的棋盘有效
+        self.__move_cache = {}
+        self.__move_cache_version = -1
+        self.__change_listeners = []  # 单位上场、离开格子时通知的函数, 见 add_change_listener()
+
+    def __getstate__(self):
+        # 缓存的快照引用了本对象的绑定方法, 不随对象一起序列化(例如发送给其他进程时), 需要时再重新创建
+        state = self.__dict__.copy()
+        state['_GameArena__snapshot'] = None
+        state['_GameArena__change_listeners'] = []  # 监听者(例如图形界面)只属于本进程
+        return state
+
+    def fork(self):
+        """返回当前局面的副本, 此后两者各自走棋互不影响
+
+        副本与本对象共用 mailbox、单位列表、攻击范围等存储以及所有单位对象, 哪一方先修改棋盘就由哪一方复制一份
+        (写时复制), 所以 fork() 本身只复制几个小字典, 只读取局面的副本几乎不占额外的内存. 副本的悔棋记录为空.
+        """
+        child = type(self).__new__(type(self))
+        child.__dict__.update(self.__dict__)
+        child.__owner_masks = dict(self.__owner_masks)
+        child.__unit_type_masks = dict(self.__unit_type_masks)
+        child.__attack_maps = dict(self.__attack_maps)
+        child.__stale_attack_maps = set(self.__stale_attack_maps)
+        child.__players = list(self.__players)
+        child.__snapshot = None  # 快照通过 attack_source 引用了本对象
+        child.__undo_stack = []
+        child.__attack_journal = None
+        child.__move_cache = {}
+        child.__change_listeners = []
+        self.__shared_lists = child.__shared_lists = True
+        self.__shared_units = child.__shared_units = (1 << len(self.__unit_info_list) + 1) - 2
+        return child
+
+    def __copy_on_write(self):
+        """修改列表之前复制与 fork() 出来的其他 arena 共用的列表"""
+        self.__shared_lists = False
+        self.__unit_info_list = list(self.__unit_info_list)
+        self.__mailbox = list(self.__mailbox)
+        self.__unit_squares = list(self.__unit_squares)
+        self.__unit_attacks = list(self.__unit_attacks)
+        self.__nodes = list(self.__nodes)
+        self.__snapshot = None
+
+    def __writable_unit(self, unit_id):
+        """返回可以修改状态的单位对象, 与其他 arena 共用的单位先复制一份"""
+        if self.__shared_lists:
+            self.__copy_on_write()
+        unit = self.__unit_info_list[unit_id - 1]
+        if self.__shared_units >> unit_id & 1:
+            self.__shared_units &= ~(1 << unit_id)
+            unit = self.__unit_info_list[unit_id - 1] = copy.copy(unit)
+            self.__nodes[unit_id] = Snapshot.Node(unit_id, unit_instance=unit)
+        return unit
+
+    def add_change_listener(self, listener):
+        """注册 listener(unit_id, old_index, new_index): 单位离开下标为 old_index 的格子时 new_index 为 None,
+        放到下标为 new_index 的格子上时 old_index 为 None
+
+        一步走子依次通知: 走子的单位离开起点, 被吃掉的单位(如有)离开终点, 走子的单位放到终点. make_move()
+        和 unmake_move() 同样会通知, 所以不应在正在搜索的 arena 上注册耗时的监听者.
+        """
+        self.__change_listeners.append(listener)
+
+    def remove_change_listener(self, listener):
+        self.__change_listeners.remove(listener)
 
     @property
     def size(self):
-        ymax = len(self.__battlefield)
-        xmax = len(self.__battlefield[0])
-        return xmax, ymax
+        return self.__width, self.__ranks
+
+    @property
+    def version(self):
+        return self.__version
+
+    @property
+    def zobrist_key(self):
+        """当前局面的 64 位 Zobrist 键值, 包括每个单位的类型、所属玩家、所在格子, 兵是否已经移动过或升变, 以及轮到哪一方走棋"""
+        return self.__zobrist_key
+
+    @property
+    def side_to_move(self):
+        return self.__side_to_move
+
+    @side_to_move.setter
+    def side_to_move(self, player_id):
+        self.__zobrist_key ^= self.__side_key(self.__side_to_move) ^ self.__side_key(player_id)
+        self.__side_to_move = player_id
+
+    def __side_key(self, player_id):
+        if player_id is None:
+            return 0
+        return zobrist_keys('side/{}'.format(player_id), 1)[0]
+
+    def __unit_key(self, unit, index):
+        state = 'moved'
+        if isinstance(unit, AbstractPawnUnit):
+            state = 'queen' if unit.has_been_queen else 'moved' if unit.has_been_moved else 'unmoved'
+        name = '{}/{}/{}'.format(type(unit).__name__, unit.owner, state)
+        return zobrist_keys(name, self.__width * self.__ranks)[index]
+
+    def __pass_turn(self, player_id):
+        """player_id 走完之后轮到下一个玩家"""
+        players = self.__players
+        self.side_to_move = players[(players.index(player_id) + 1) % len(players)]
+
+    def square_index(self, square):
+        """Square(x, y) 在 mailbox 和位棋盘中对应的下标, 坐标越界时抛出 ValueError"""
+        x, y = square[0], square[1]
+        if x < 0 or y < 0 or x >= self.__width or y >= self.__ranks:
+            raise ValueError('invalid square:{}'.format(square))
+        return x + y * self.__width
+
+    def square_from_index(self, index):
+        return Square(index % self.__width, index // self.__width)
+
+    def occupancy_mask(self, player_id=None):
+        """返回被占领格子的位棋盘, 指定 player_id 时只包括该玩家的单位"""
+        if player_id is None:
+            return self.__occupancy
+        return self.__owner_masks.get(player_id, 0)
+
+    def unit_type_mask(self, unit_type):
+        """返回类型为 unit_type 的所有单位(不分敌我)占领格子的位棋盘"""
+        return self.__unit_type_masks.get(unit_type, 0)
 
     def new_unit_recruited_by_player(self, player_id, square, unit_type):
+        index = self.square_index(square) if square else None
+        unit_id = self.__recruit(player_id, index, unit_type)
+        if index is not None:
+            self.__refresh_attacks(unit_id)
+        return unit_id
+
+    def __recruit(self, player_id, index, unit_type, has_been_moved=False):
+        """招募单位并放在下标为 index 的格子上(index 为 None 时暂不上场), 不刷新攻击范围"""
+        if self.__shared_lists:
+            self.__copy_on_write()
         unit = unit_type(owner=player_id)
         self.__unit_info_list.append(unit)
+        self.__unit_squares.append(None)
+        self.__unit_attacks.append(0)
         unit_id = self.UnitID(len(self.__unit_info_list))
-        unit.has_been_moved = False
-        if square:
-            x, y = square[0], square[1]
-            xmax, ymax = self.size
-            if x < 0 or y < 0 or x >= xmax or y >= ymax:
-                raise ValueError('invalid square:{}'.format(square))
-            self.__battlefield[y][x] = unit_id
+        self.__nodes.append(Snapshot.Node(unit_id, unit_instance=unit))
+        unit.has_been_moved = has_been_moved
+        if player_id not in self.__players:
+            self.__players.append(player_id)
+            if self.__side_to_move is None:
+                self.side_to_move = player_id
+        if index is not None:
+            self.__put_unit(unit_id, index)
         return unit_id
 
+    @classmethod
+    def from_fen(cls, fen):
+        """按 FEN 建立 GameArena: 大写字母为白方 PlayerID(1), 小写字母为黑方 PlayerID(2)
+
+        棋盘尺寸由棋子布局决定. 兵不在初始行(白方第 1 行, 黑方倒数第 2 行)上即视为已经移动过;
+        王和车按易位权利字段还原是否移动过. 吃过路兵和步数字段被忽略.
+        """
+        fields = fen.split()
+        if not fields:
+            raise ValueError('empty FEN')
+        rows = fields[0].split('/')
+        ranks = len(rows)
+        width = sum(int(c) if c.isdigit() else 1 for c in re.findall(r'\d+|.', rows[0]))
+        arena = cls(width, ranks)
+        white, black = FEN_PLAYERS
+        arena.__players = [white, black]
+        castling = fields[2] if len(fields) > 2 else '-'
+        unmoved_rooks = {
+            (0, 0): 'Q' in castling, (width - 1, 0): 'K' in castling,
+            (0, ranks - 1): 'q' in castling, (width - 1, ranks - 1): 'k' in castling,
+        }
+        pieces = FEN_PIECES
+        for row_number, row in enumerate(rows):
+            y = ranks - 1 - row_number
+            x = 0
+            for token in re.findall(r'\d+|.', row):
+                if token.isdigit():
+                    x += int(token)
+                    continue
+                try:
+                    player_id, unit_type = pieces[token]
+                except KeyError:
+                    raise ValueError('invalid piece {!r} in FEN: {}'.format(token, fen))
+                if x >= width:
+                    raise ValueError('rank {} is too long in FEN: {}'.format(ranks - y, fen))
+                if unit_type is WhitePawnUnit:
+                    has_been_moved = y != 1
+                elif unit_type is BlackPawnUnit:
+                    has_been_moved = y != ranks - 2
+                elif unit_type is KingUnit:
+                    has_been_moved = not any(c in castling for c in ('KQ' if player_id == white else 'kq'))
+                elif unit_type is RookUnit:
+                    has_been_moved = not unmoved_rooks.get((x, y), False)
+                else:
+                    has_been_moved = False
+                arena.__recruit(player_id, x + y * width, unit_type, has_been_moved)
+                x += 1
+            if x != width:
+                raise ValueError('rank {} has {} squares instead of {} in FEN: {}'.format(ranks - y, x, width, fen))
+        side = fields[1] if len(fields) > 1 else 'w'
+        if side not in ('w', 'b'):
+            raise ValueError('invalid side to move {!r} in FEN: {}'.format(side, fen))
+        arena.side_to_move = white if side == 'w' else black
+        arena.__refresh_all_attacks()
+        return arena
+
+    def to_fen(self):
+        """导出 FEN(只支持 PlayerID(1) 和 PlayerID(2) 两个玩家). 升变后的兵记为后; 步数字段固定为 "0 1" """
+        return '{} 0 1'.format(self.__fen_position())
+
+    @classmethod
+    def from_epd(cls, epd):
+        """解析 EPD: 前四个字段与 FEN 相同, 随后是以分号结尾的操作, 例如 bm e4; id "start";
+
+        返回 (GameArena, 有序字典{操作码: [操作数, ...]}).
+        """
+        fields = epd.split(None, 4)
+        if len(fields) < 4:
+            raise ValueError('EPD needs at least four fields: {}'.format(epd))
+        arena = cls.from_fen(' '.join(fields[:4]))
+        operations = collections.OrderedDict()
+        text = fields[4] if len(fields) > 4 else ''
+        for operation in re.findall(r'(?:"[^"]*"|[^;"])+', text):
+            tokens = re.findall(r'"[^"]*"|\S+', operation)
+            if tokens:
+                operations[tokens[0]] = [t[1:-1] if t.startswith('"') else t for t in tokens[1:]]
+        return arena, operations
+
+    def to_epd(self, operations=None):
+        """导出 EPD, operations 为 {操作码: [操作数, ...]}, 含空格的操作数会加上引号"""
+        text = self.__fen_position()
+        for opcode, operands in (operations or {}).items():
+            quoted = ['"{}"'.format(o) if not o or ' ' in o or ';' in o else o for o in map(str, operands)]
+            text += ' ' + ' '.join([opcode] + quoted) + ';'
+        return text
+
+    def __fen_position(self):
+        """FEN 的前四个字段: 棋子布局、走棋方、易位权利、吃过路兵的目标格"""
+        width, ranks = self.size
+        white, black = FEN_PLAYERS
+        letters = FEN_LETTERS
+        rows = []
+        for y in range(ranks - 1, -1, -1):
+            row = ''
+            empty = 0
+            for index in range(y * width, y * width + width):
+                unit_id = self.__mailbox[index]
+                if not unit_id:
+                    empty += 1
+                    continue
+                unit = self.__unit_info_list[unit_id - 1]
+                if isinstance(unit, AbstractPawnUnit) and unit.has_been_queen:
+                    letter = 'Q'
+                else:
+                    letter = letters[type(unit)]
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += letter if unit.owner == white else letter.lower()
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        castling = ''
+        for player_id, y, king_side, queen_side in ((white, 0, 'K', 'Q'), (black, ranks - 1, 'k', 'q')):
+            if not self.__is_unmoved(player_id, KingUnit, width // 2 + y * width):
+                continue
+            if self.__is_unmoved(player_id, RookUnit, width - 1 + y * width):
+                castling += king_side
+            if self.__is_unmoved(player_id, RookUnit, y * width):
+                castling += queen_side
+        side = 'b' if self.__side_to_move == black else 'w'
+        return '{} {} {} -'.format('/'.join(rows), side, castling or '-')
+
+    def __is_unmoved(self, player_id, unit_type, index):
+        unit_id = self.__mailbox[index] if 0 <= index < len(self.__mailbox) else 0
+        if not unit_id:
+            return False
+        unit = self.__unit_info_list[unit_id - 1]
+        return type(unit) is unit_type and unit.owner == player_id and not unit.has_been_moved
+
+    def unit_info(self, unit_id):
+        """返回单位对象(类型、所属玩家、是否移动过、是否已经升变等), 调用者不应直接修改它"""
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} not exists'.format(unit_id))
+        return self.__unit_info_list[unit_id - 1]
+
+    def unit_id_at(self, index):
+        """返回下标为 index 的格子上的单位编码, 空格返回 UnitID(0)"""
+        return self.__mailbox[index]
+
     def owner_of_unit(self, unit_id):
         if not self.is_valid_unit_id(unit_id):
             raise ValueError('unit_id:{} not exists'.format(unit_id))
         return self.__unit_info_list[unit_id - 1].owner
 
+    def __put_unit(self, unit_id, index):
+        """把单位放在下标为 index 的格子上, 原先占领该格子的单位(如有)被吃掉并移出棋盘"""
+        if self.__shared_lists:
+            self.__copy_on_write()
+        captured_id = self.__mailbox[index]
+        if captured_id:
+            self.__remove_unit(captured_id, index)
+        unit = self.__unit_info_list[unit_id - 1]
+        bit = 1 << index
+        self.__mailbox[index] = unit_id
+        self.__unit_squares[unit_id - 1] = index
+        self.__occupancy |= bit
+        self.__owner_masks[unit.owner] = self.__owner_masks.get(unit.owner, 0) | bit
+        self.__unit_type_masks[type(unit)] = self.__unit_type_masks.get(type(unit), 0) | bit
+        self.__zobrist_key ^= self.__unit_key(unit, index)
+        self.__changed_squares |= bit
+        self.__version += 1
+        if self.__change_listeners:
+            for listener in list(self.__change_listeners):
+                listener(unit_id, None, index)
+
+    def __remove_unit(self, unit_id, index):
+        if self.__shared_lists:
+            self.__copy_on_write()
+        unit = self.__unit_info_list[unit_id - 1]
+        bit = 1 << index
+        self.__mailbox[index] = self.UnitID(0)
+        self.__unit_squares[unit_id - 1] = None
+        self.__occupancy &= ~bit
+        self.__owner_masks[unit.owner] &= ~bit
+        self.__unit_type_masks[type(unit)] &= ~bit
+        self.__zobrist_key ^= self.__unit_key(unit, index)
+        self.__changed_squares |= bit
+        if self.__unit_attacks[unit_id - 1]:
+            if self.__attack_journal is not None:
+                self.__attack_journal.append((unit_id - 1, self.__unit_attacks[unit_id - 1]))
+            self.__unit_attacks[unit_id - 1] = 0
+            self.__stale_attack_maps.add(unit.owner)
+        self.__version += 1
+        if self.__change_listeners:
+            for listener in list(self.__change_listeners):
+                listener(unit_id, index, None)
+
     def __place_unit_on_square(self, unit_id, square):
-        x, y = square[0], square[1]
-        try:
-            square_before_move = self.find_square_from_unit_id(unit_id)
-        except ValueError:
-            pass
-        else: 
-            self.__battlefield[square_before_move.y][square_before_move.x] = self.UnitID(0)
-     
-        self.__battlefield[y][x] = unit_id
-        
-        unit = self.__unit_info_list[unit_id-1]
+        index = self.square_index(square)
+        index_before_move = self.__unit_squares[unit_id - 1]
+        if index_before_move is not None:
+            self.__remove_unit(unit_id, index_before_move)
+        # 移动和升变状态要在单位重新放回棋盘之前更新, Zobrist 键值才能按新状态计入
+        unit = self.__writable_unit(unit_id)
+        unit.has_been_moved = True
         if isinstance(unit,AbstractPawnUnit):
-            unit.check_bottom(y)
+            unit.check_bottom(index // self.__width, self.__ranks)
+     
+        self.__put_unit(unit_id, index)
+        self.__refresh_attacks(unit_id)
+        self.__pass_turn(unit.owner)
+
+    def __refresh_attacks(self, moved_unit_id):
+        """走子后增量更新攻击范围
+
+        只有刚移动的单位, 以及攻击范围覆盖了占领状态发生变化的格子的单位(射线被打开或被挡住)需要重算,
+        其余单位的攻击范围保持不变.
+        """
+        if self.__shared_lists:
+            self.__copy_on_write()
+        changed = self.__changed_squares
+        self.__changed_squares = 0
+        snapshot = self.__take_snapshot()
+        unit_attacks = self.__unit_attacks
+        for i, index in enumerate(self.__unit_squares):
+            if index is None or not (i + 1 == moved_unit_id or unit_attacks[i] & changed):
+                continue
+            unit = self.__unit_info_list[i]
+            mask = unit.shooting_mask(index, snapshot)
+            if mask != unit_attacks[i]:
+                if self.__attack_journal is not None:
+                    self.__attack_journal.append((i, unit_attacks[i]))
+                unit_attacks[i] = mask
+                self.__stale_attack_maps.add(unit.owner)
+
+    def __refresh_all_attacks(self):
+        """从头计算所有单位的攻击范围(用于一次摆好整个局面之后)"""
+        if self.__shared_lists:
+            self.__copy_on_write()
+        self.__changed_squares = 0
+        snapshot = self.__take_snapshot()
+        for i, index in enumerate(self.__unit_squares):
+            unit = self.__unit_info_list[i]
+            self.__unit_attacks[i] = 0 if index is None else unit.shooting_mask(index, snapshot)
+            self.__stale_attack_maps.add(unit.owner)
+
+    def attacked_squares_mask(self, player_id):
+        """返回 player_id 一方所有单位攻击范围的位棋盘"""
+        if player_id in self.__stale_attack_maps or player_id not in self.__attack_maps:
+            mask = 0
+            for unit, attacks in zip(self.__unit_info_list, self.__unit_attacks):
+                if unit.owner == player_id:
+                    mask |= attacks
+            self.__attack_maps[player_id] = mask
+            self.__stale_attack_maps.discard(player_id)
+        return self.__attack_maps[player_id]
+
+    def enemy_attacks_mask(self, player_id, ignored_square=None):
+        """返回 player_id 的所有对手攻击范围的并集
+
+        指定 ignored_square 时按该格子上的单位已经离开来计算, 即穿过该格子的射线会继续延伸(国王不能沿被攻击的射线后退).
+        """
+        result = 0
+        for owner in self.__owner_masks:
+            if owner != player_id:
+                result |= self.attacked_squares_mask(owner)
+        if ignored_square is None:
+            return result
+        index = self.square_index(ignored_square)
+        bit = 1 << index
+        if not result & bit:
+            return result
+        snapshot = self.__take_snapshot().without(ignored_square)
+        for i, attacks in enumerate(self.__unit_attacks):
+            if attacks & bit:
+                unit = self.__unit_info_list[i]
+                if unit.owner != player_id:
+                    result |= unit.shooting_mask(self.__unit_squares[i], snapshot)
+        return result
+
+    def is_in_check(self, player_id):
+        """player_id 一方的国王是否正处于对手的攻击范围之内"""
+        kings = self.__unit_type_masks.get(KingUnit, 0) & self.__owner_masks.get(player_id, 0)
+        return bool(kings & self.enemy_attacks_mask(player_id))
 
     def move_unit_to_somewhere(self, unit_id, square):
         
         if not self.is_valid_unit_id(unit_id):
             raise ValueError('unit_id:{} does not exist'.format(unit_id))
-        x, y = square[0], square[1]
-        xmax, ymax = self.size
-        if x < 0 or y < 0 or x >= xmax or y >= ymax:
-            raise ValueError('invalid square:{}'.format(square))
+        self.square_index(square)  # 坐标越界则抛出 ValueError 异常
         self.__place_unit_on_square(unit_id, square)
-        self.__unit_info_list[unit_id - 1].has_been_moved = True
+        del self.__undo_stack[:]  # 不可悔棋的走法之后, 之前的悔棋记录不再有效
+        self.__move_cache.clear()
+
+    def make_move(self, move):
+        """执行 generate_moves() 给出的一个走法, 并记录悔棋信息以便 unmake_move() 还原
+
+        与 move_unit_to_somewhere() 一样不检查走法是否合规. 返回被吃掉的单位编码, 没有吃子时返回 UnitID(0).
+        """
+        from_index, to_index = move & MOVE_SQUARE_MASK, move >> MOVE_SQUARE_BITS & MOVE_SQUARE_MASK
+        unit_id = self.__mailbox[from_index]
+        if not unit_id:
+            raise ValueError('no unit on square index:{}'.format(from_index))
+        unit = self.__writable_unit(unit_id)
+        captured_id = self.__mailbox[to_index]
+        has_been_moved = unit.has_been_moved
+        has_been_queen = getattr(unit, 'has_been_queen', None)
+        side_to_move = self.__side_to_move
+        journal = self.__attack_journal = []
+        try:
+            self.__remove_unit(unit_id, from_index)
+            unit.has_been_moved = True
+            if has_been_queen is False:
+                unit.check_bottom(to_index // self.__width, self.__ranks)
+            self.__put_unit(unit_id, to_index)
+            self.__refresh_attacks(unit_id)
+        finally:
+            self.__attack_journal = None
+        self.__pass_turn(unit.owner)
+        self.__undo_stack.append((unit_id, from_index, to_index, captured_id, has_been_moved, has_been_queen,
+                                  side_to_move, journal))
+        return captured_id
+
+    def unmake_move(self):
+        """撤销最近一次 make_move(), 还原棋盘、被吃掉的单位、移动和升变状态以及攻击范围"""
+        try:
+            unit_id, from_index, to_index, captured_id, has_been_moved, has_been_queen, side_to_move, journal = \
+                self.__undo_stack.pop()
+        except IndexError:
+            raise ValueError('no move to unmake')
+        unit = self.__writable_unit(unit_id)
+        self.__remove_unit(unit_id, to_index)
+        unit.has_been_moved = has_been_moved
+        if has_been_queen is not None:
+            unit.has_been_queen = has_been_queen
+        self.__put_unit(unit_id, from_index)
+        if captured_id:
+            self.__put_unit(captured_id, to_index)
+        self.side_to_move = side_to_move
+        unit_attacks = self.__unit_attacks
+        for i, attacks in reversed(journal):
+            unit_attacks[i] = attacks
+            self.__stale_attack_maps.add(self.__unit_info_list[i].owner)
+        self.__changed_squares = 0
+
+    @property
+    def undo_depth(self):
+        """make_move() 之后尚可 unmake_move() 的步数"""
+        return len(self.__undo_stack)
+
+    def mark_unit_as_moved(self, unit_id, has_been_moved=True):
+        """直接设置单位是否移动过(例如按已知局面摆放棋子时), 不算作走子"""
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} does not exist'.format(unit_id))
+        unit = self.__writable_unit(unit_id)
+        index = self.__unit_squares[unit_id - 1]
+        if index is not None:
+            self.__zobrist_key ^= self.__unit_key(unit, index)
+        unit.has_been_moved = has_been_moved
+        if index is not None:
+            self.__zobrist_key ^= self.__unit_key(unit, index)
+        self.__move_cache.clear()  # 兵能否走两格取决于是否移动过, 而棋盘版本号没有变化
 
     def is_valid_unit_id(self, unit_id):
         
@@ -86,85 +616,389 @@ class GameArena:
         result = {}
         if not self.is_valid_unit_id(unit_id):
             return result
-        square = self.find_square_from_unit_id(unit_id)  # 找不到则会向上传递 ValueError 异常
+        entry = self.__cached_moves(unit_id)
+        if entry[1] is None:
+            entry[1] = AttackTables.for_size(self.__width, self.__ranks).squares_of(entry[0])
+        return entry[1]
+
+    def valid_moves_mask_of_unit(self, unit_id):
+        """单位可以走到的格子的位棋盘, 与 retrieve_valid_moves_of_unit() 共用同一个缓存"""
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} does not exist'.format(unit_id))
+        return self.__cached_moves(unit_id)[0]
+
+    def __cached_moves(self, unit_id):
+        """按 (棋盘版本号, 单位编码) 缓存的走法; 同一局面下反复查询同一个单位(例如图形界面拖动棋子时)不再重新计算"""
+        if self.__move_cache_version != self.__version:
+            self.__move_cache.clear()
+            self.__move_cache_version = self.__version
+        try:
+            return self.__move_cache[unit_id]
+        except KeyError:
+            pass
+        index = self.__unit_squares[unit_id - 1]
+        if index is None:
+            raise ValueError('Note: unit_id:{} is not on chessboard'.format(unit_id))
         unit = self.__unit_info_list[unit_id - 1]
-        return unit.retrieve_valid_moves(starting_square=square, snapshot=self.__take_snapshot())
+        entry = self.__move_cache[unit_id] = [unit.valid_moves_mask(index, self.__take_snapshot()), None]
+        return entry
+
+    def generate_moves(self, player_id=None):
+        """一次性生成 player_id(默认为轮到走棋的一方)所有单位的走法
+
+        所有单位共用同一个快照, 结果是 pack_move() 编码的 array('L'), 每个走法占一个元素.
+        """
+        if player_id is None:
+            player_id = self.__side_to_move
+        xmax, ymax = self.size
+        if xmax * ymax > 1 << MOVE_SQUARE_BITS:
+            raise ValueError('board too large for packed moves: {}x{}'.format(xmax, ymax))
+        snapshot = self.__take_snapshot()
+        own = self.__owner_masks.get(player_id, 0)
+        enemies = self.__occupancy & ~own
+        mailbox, units = self.__mailbox, self.__unit_info_list
+        flag_shift = 2 * MOVE_SQUARE_BITS
+        moves = array.array('L')
+        for from_index in iterate_bits(own):
+            unit = units[mailbox[from_index] - 1]
+            targets = unit.valid_moves_mask(from_index, snapshot)
+            promotable = isinstance(unit, AbstractPawnUnit) and not unit.has_been_queen
+            for to_index in iterate_bits(targets):
+                flags = enemies >> to_index & MOVE_FLAG_CAPTURE
+                if promotable and unit.is_bottom(to_index // xmax, ymax):
+                    flags |= MOVE_FLAG_PROMOTION
+                moves.append(from_index | to_index << MOVE_SQUARE_BITS | flags << flag_shift)
+        return moves
 
     def find_square_from_unit_id(self, unit_id):
         
         if not self.is_valid_unit_id(unit_id):
             raise ValueError('Error: invalid unit_id:{}'.format(unit_id))
-        for y in range(len(self.__battlefield)):
-            rank = self.__battlefield[y]
-            for x in range(len(rank)):
-                if unit_id == rank[x]:
-                    return Square(x, y)
-        raise ValueError('Note: unit_id:{} is not on chessboard'.format(unit_id))
+        index = self.__unit_squares[unit_id - 1]
+        if index is None:
+            raise ValueError('Note: unit_id:{} is not on chessboard'.format(unit_id))
+        return Square(index % self.__width, index // self.__width)
+
+    def find_unit_id_on_square(self, square):
+        """返回占领该格子的单位编码, 空格返回 UnitID(0), 坐标越界时抛出 ValueError"""
+        return self.__mailbox[self.square_index(square)]
 
     def is_occupied_square(self, square):
-        x, y = square[0], square[1]
-        xmax, ymax = self.size
-        if x < 0 or y < 0 or x >= xmax or y >= ymax:
+        try:
+            index = self.square_index(square)
+        except ValueError:
             return False
-        return self.__battlefield[y][x] > 0
+        return bool(self.__occupancy >> index & 1)
 
     def __take_snapshot(self):
-        builder = SnapshotBuilder(self.size)
-        for y in range(len(self.__battlefield)):
-            rank = self.__battlefield[y]
-            for x in range(len(rank)):
-                unit_id = rank[x]
-                if unit_id > 0:
-                    unit = self.__unit_info_list[unit_id - 1]
-                else:
-                    unit = None
-                builder.set_node(x, y, unit_id, unit_instance=unit)
-        return builder.snapshot
+        snapshot = self.__snapshot
+        if snapshot is None or snapshot.version != self.__version:
+            snapshot = Snapshot(self.size, self.__mailbox, self.__nodes, self.__occupancy, dict(self.__owner_masks),
+                                self.__version, attack_source=self.enemy_attacks_mask)
+            self.__snapshot = snapshot
+        return snapshot
+
+
+def iterate_bits(mask):
+    """按从低到高的顺序逐一给出位棋盘 mask 中为 1 的位的下标"""
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+class TranspositionTable(object):
+    """以 GameArena.zobrist_key 为键的定长置换表
+
+    共有 entries 个槽位, 每两个槽位组成一个桶. 默认(depth_preferred=True)桶中第一个槽位只保留搜索深度最大的记录,
+    第二个槽位总是被新记录覆盖; depth_preferred=False 时每个桶只用一个槽位且总是覆盖. 每条记录包括
+    搜索深度、分值(整数)、最佳走法(pack_move() 编码)和分值的性质(EXACT/LOWER_BOUND/UPPER_BOUND).
+    """
+
+    EXACT = 0
+    LOWER_BOUND = 1
+    UPPER_BOUND = 2
+
+    def __init__(self, entries=1 << 16, depth_preferred=True):
+        if entries < 2 or entries & (entries - 1):
+            raise ValueError('entries must be a power of two: {}'.format(entries))
+        self.depth_preferred = depth_preferred
+        self.__bucket_mask = (entries >> 1) - 1 if depth_preferred else entries - 1
+        self.__keys = [None] * entries
+        self.__depths = [0] * entries
+        self.__records = [None] * entries  # (分值, 最佳走法, 分值性质)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0  # 覆盖了其他局面的记录的次数
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def clear(self):
+        entries = len(self.__keys)
+        self.__keys = [None] * entries
+        self.__depths = [0] * entries
+        self.__records = [None] * entries
+        self.hits = self.misses = self.stores = self.replacements = 0
+
+    def __slots_of(self, key):
+        bucket = key & self.__bucket_mask
+        if self.depth_preferred:
+            return bucket << 1, bucket << 1 | 1
+        return bucket, bucket
+
+    def probe(self, key):
+        """返回 (深度, 分值, 最佳走法, 分值性质), 没有记录时返回 None"""
+        for slot in self.__slots_of(key):
+            if self.__keys[slot] == key:
+                self.hits += 1
+                value, move, bound = self.__records[slot]
+                return self.__depths[slot], value, move, bound
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, value, move=0, bound=EXACT):
+        deep, always = self.__slots_of(key)
+        keys = self.__keys
+        if keys[deep] == key or keys[deep] is None or depth >= self.__depths[deep]:
+            slot = deep
+        else:
+            slot = always
+        if keys[slot] is not None and keys[slot] != key:
+            self.replacements += 1
+        keys[slot] = key
+        self.__depths[slot] = depth
+        self.__records[slot] = (value, move, bound)
+        self.stores += 1
+
+    @property
+    def hit_rate(self):
+        probes = self.hits + self.misses
+        return self.hits / float(probes) if probes else 0.0
+
+
+class SnapshotNode(object):
+    """快照中一个格子上的内容, 即 Snapshot.Node
+
+    定义在模块一级而不是嵌套在 Snapshot 中, Python 2 的 pickle 才能按名字找到这个类(例如把 GameArena 发送给其他进程时).
+    """
+    __slots__ = ('unit_id', 'unit')
+
+    def __init__(self, unit_id, unit_instance=None):
+        self.unit_id = unit_id
+        self.unit = unit_instance
+
+
+class Snapshot(object):
+    """棋盘的只读视图
+
+    Snapshot 与创建它的 GameArena 共享 mailbox 存储, 不复制任何格子. 每个单位对应的 Node 在招募时创建一次,
+    此后所有查询都返回同一个 Node 对象. version 记录创建视图时的棋盘版本号, 棋盘变化后 GameArena 会换用新的视图,
+    旧视图不应再被使用.
+    """
+
+    Node = SnapshotNode
+    EMPTY_NODE = SnapshotNode(unit_id=0, unit_instance=None)
 
+    def __init__(self, size, mailbox, nodes, occupancy, owner_masks, version=0, hidden_index=None,
+                 attack_source=None):
+        self.xmax, self.ymax = size[0], size[1]
+        self.version = version
+        self.occupancy = occupancy  # 创建视图时被占领格子的位棋盘
+        self.tables = AttackTables.for_size(self.xmax, self.ymax)
+        self.__mailbox = mailbox  # 按 x + y*xmax 排列的单位编码, 与 GameArena 共享
+        self.__nodes = nodes  # 单位编码 -> Node, 编码 0 对应 EMPTY_NODE
+        self.__owner_masks = owner_masks  # PlayerID -> 该玩家占领格子的位棋盘
+        self.__hidden_index = hidden_index
+        self.__attack_source = attack_source  # GameArena.enemy_attacks_mask, 手工构造的快照没有
 
-class Snapshot(dict):
-    xmax = 0
-    ymax = 0
+    def occupancy_of(self, owner):
+        """返回 owner 一方的单位所占领格子的位棋盘"""
+        return self.__owner_masks.get(owner, 0) & self.occupancy
 
     def get_node(self, x, y):
-        try:
-            return self[Square(x, y)]
-        except KeyError:
-            if 0 <= x < self.xmax and 0 <= y < self.ymax:
-                return Snapshot.Node(unit_id=0, unit_instance=None)
-            # 否则上报一个 ValueError 异常:
-            raise ValueError('Error: x,y: get_node(x={},y={})'.format(x, y))
+        if 0 <= x < self.xmax and 0 <= y < self.ymax:
+            index = x + y * self.xmax
+            if index == self.__hidden_index:
+                return Snapshot.EMPTY_NODE
+            return self.__nodes[self.__mailbox[index]]
+        # 否则上报一个 ValueError 异常:
+        raise ValueError('Error: x,y: get_node(x={},y={})'.format(x, y))
+
+    def without(self, square):
+        """返回把 square 上的单位视为不存在的视图(仍然共享存储), 用于推演该单位离开原位之后的局面"""
+        index = square[0] + square[1] * self.xmax
+        return Snapshot((self.xmax, self.ymax), self.__mailbox, self.__nodes, self.occupancy & ~(1 << index),
+                        self.__owner_masks, self.version, hidden_index=index, attack_source=self.__attack_source)
+
+    def enemy_attacks_mask(self, owner, ignored_square=None):
+        """返回 owner 的所有对手攻击范围的并集, 指定 ignored_square 时视该格子上的单位已经离开
+
+        由 GameArena 创建的快照直接读取其增量维护的攻击范围, 否则逐一计算每个敌方单位的攻击范围.
+        """
+        if self.__attack_source is not None:
+            return self.__attack_source(owner, ignored_square)
+        snapshot = self if ignored_square is None else self.without(ignored_square)
+        result = 0
+        for square, node in snapshot.items():
+            if node.unit_id and node.unit.owner != owner:
+                result |= node.unit.shooting_mask(square.x + square.y * snapshot.xmax, snapshot)
+        return result
+
+    def __getitem__(self, square):
+        return self.get_node(square[0], square[1])
+
+    def __len__(self):
+        return bin(self.occupancy).count('1')
 
-    class Node:
-        def __init__(self, unit_id, unit_instance=None):
-            self.unit_id = unit_id
-            self.unit = unit_instance
+    def __iter__(self):
+        """逐一给出被占领的格子"""
+        for index in iterate_bits(self.occupancy):
+            yield Square(index % self.xmax, index // self.xmax)
+
+    def items(self):
+        for square in self:
+            yield square, self.get_node(square.x, square.y)
 
 
 class SnapshotBuilder:
+    """在 GameArena 之外手工构造 Snapshot, 例如用于单独测试某个单位的走法"""
+
     def __init__(self, size):
         self.__xmax, self.__ymax = size[0], size[1]
-        self.__nodes = {}
+        self.__mailbox = [0] * (self.__xmax * self.__ymax)
+        self.__nodes = {0: Snapshot.EMPTY_NODE}
+        self.__occupancy = 0
 
     @property
     def snapshot(self):
-        s = Snapshot(self.__nodes.items())
-        s.xmax = self.__xmax
-        s.ymax = self.__ymax
-        return s
+        owner_masks = {}
+        for index in iterate_bits(self.__occupancy):
+            unit = self.__nodes[self.__mailbox[index]].unit
+            if unit is not None:
+                owner_masks[unit.owner] = owner_masks.get(unit.owner, 0) | 1 << index
+        return Snapshot((self.__xmax, self.__ymax), list(self.__mailbox), dict(self.__nodes), self.__occupancy,
+                        owner_masks)
 
     def set_node(self, x, y, unit_id, unit_instance):
         if 0 <= x < self.__xmax and 0 <= y < self.__ymax:
-            self.__nodes[Square(x, y)] = Snapshot.Node(unit_id, unit_instance)
+            index = x + y * self.__xmax
+            self.__mailbox[index] = unit_id
+            if unit_id:
+                self.__nodes[unit_id] = Snapshot.Node(unit_id, unit_instance)
+                self.__occupancy |= 1 << index
+            else:
+                self.__occupancy &= ~(1 << index)
         else:
             raise ValueError('Error: 坐标越界: set_node(x={},y={})'.format(x, y))
 
 
+class AttackTables(object):
+    """按棋盘尺寸预先计算的攻击表
+
+    对每个格子和每个方向预先算出整条射线的位棋盘. 跳跃类单位(马、王、兵的斜吃)直接查表;
+    滑动类单位(车、象、后)对每个方向用占领位棋盘找出射线上第一个阻挡者, 再用阻挡者所在格子的同向射线
+    去掉阻挡者身后的格子, 每个方向只需几次整数位运算, 不必逐格前进.
+    """
+
+    __cache = {}
+
+    @classmethod
+    def for_size(cls, width, ranks):
+        try:
+            return cls.__cache[width, ranks]
+        except KeyError:
+            tables = cls.__cache[width, ranks] = cls(width, ranks)
+            return tables
+
+    def __init__(self, width, ranks):
+        self.width, self.ranks = width, ranks
+        self.squares = tuple(Square(i % width, i // width) for i in range(width * ranks))  # 下标 -> Square
+        self.__rays = {}  # (方向, 步数上限) -> (每个格子出发的射线位棋盘, 射线是否朝下标增大的方向)
+        self.__leaps = {}  # 方向元组 -> 每个格子出发单步可达格子的位棋盘
+
+    def ray_masks(self, direction, limit=0):
+        """从每个格子出发沿 direction 最多走 limit 步(0 表示不限)所经过格子的位棋盘"""
+        key = (direction, limit)
+        try:
+            return self.__rays[key][0]
+        except KeyError:
+            pass
+        dx, dy = direction
+        masks = []
+        for y in range(self.ranks):
+            for x in range(self.width):
+                mask = 0
+                step = 0
+                tx, ty = x + dx, y + dy
+                while 0 <= tx < self.width and 0 <= ty < self.ranks and (limit <= 0 or step < limit):
+                    step += 1
+                    mask |= 1 << (tx + ty * self.width)
+                    tx, ty = tx + dx, ty + dy
+                masks.append(mask)
+        self.__rays[key] = (tuple(masks), dx + dy * self.width > 0)
+        return self.__rays[key][0]
+
+    def leap_masks(self, directions):
+        """从每个格子出发沿 directions 中各方向只走一步可达格子的位棋盘"""
+        directions = tuple(directions)
+        try:
+            return self.__leaps[directions]
+        except KeyError:
+            pass
+        masks = [0] * (self.width * self.ranks)
+        for direction in directions:
+            for i, ray in enumerate(self.ray_masks(direction, limit=1)):
+                masks[i] |= ray
+        masks = self.__leaps[directions] = tuple(masks)
+        return masks
+
+    def slide_mask(self, index, directions, occupancy, limit=0):
+        """从下标为 index 的格子出发沿各方向滑动, 直到(并包括)遇到的第一个被占领格子"""
+        result = 0
+        for direction in directions:
+            try:
+                rays, increasing = self.__rays[direction, limit]
+            except KeyError:
+                self.ray_masks(direction, limit)
+                rays, increasing = self.__rays[direction, limit]
+            ray = rays[index]
+            blockers = ray & occupancy
+            if blockers:
+                if increasing:
+                    first = (blockers & -blockers).bit_length() - 1
+                else:
+                    first = blockers.bit_length() - 1
+                ray &= ~rays[first]
+            result |= ray
+        return result
+
+    def shooting_mask(self, index, directions, limited_move_range, occupancy):
+        if limited_move_range == 1:
+            return self.leap_masks(directions)[index]
+        return self.slide_mask(index, directions, occupancy, limited_move_range)
+
+    def squares_of(self, mask):
+        """把位棋盘转换为 Square 元组(按下标从小到大排列)"""
+        squares = self.squares
+        return tuple(squares[i] for i in iterate_bits(mask))
+
+
 import abc
 
 
+QUEEN_DIRECTIONS = (
+    Vector(1, 0), Vector(1, 1), Vector(0, 1), Vector(-1, 1),
+    Vector(-1, 0), Vector(-1, -1), Vector(0, -1), Vector(1, -1),
+)
+
+
 class AbstractPawnUnit(Unit):
     __metaclass__ = abc.ABCMeta
+    __slots__ = ('has_been_queen',)
+
+    attack_directions = ()  # 前方两个斜角, 由子类按前进方向给出
 
     @abc.abstractproperty
     def pawn_charge_direction(self):
@@ -178,142 +1012,97 @@ class AbstractPawnUnit(Unit):
 
     def retrieve_valid_moves(self, starting_square, snapshot):
         
+        index = starting_square[0] + starting_square[1] * snapshot.xmax
+        return snapshot.tables.squares_of(self.valid_moves_mask(index, snapshot))
+
+    def valid_moves_mask(self, index, snapshot):
         if self.has_been_queen:
-            return self.retrieve_valid_moves_queen(starting_square, snapshot)
-        result = []
-
-        dx, dy = self.pawn_charge_direction
-        x, y = starting_square.x + dx, starting_square.y + dy
-        max_steps = 1
-        if not self.has_been_moved:
-            max_steps = 2
-        step = 1
-        squares = []
-        while step <= max_steps:
-            step += 1
-            if y < 0 or y >= snapshot.ymax:
-                break  
-            other_unit_id = snapshot.get_node(x, y).unit_id
-            if not other_unit_id:
-                squares.append(Square(x, y))
-                y += dy
-        result += squares
-
-
-        dy = self.pawn_charge_direction.dy
-        squares = []
-        for x, y in self.retrieve_squares_within_shooting_range(starting_square, snapshot):
-            node = snapshot.get_node(x, y)
-            if not node.unit_id:
-                continue  
-            unit = node.unit
-            if unit.owner == self.owner:
-                continue 
-            squares.append(Square(x, y))
-        result += squares
-        return tuple(result)
+            mask = snapshot.tables.slide_mask(index, QUEEN_DIRECTIONS, snapshot.occupancy)
+            return mask & ~snapshot.occupancy_of(self.owner)
+        # 沿纵列前进(第一次移动时可以走两格), 不能越过也不能吃掉前方的单位:
+        max_steps = 1 if self.has_been_moved else 2
+        charge = (self.pawn_charge_direction,)
+        result = snapshot.tables.slide_mask(index, charge, snapshot.occupancy, max_steps) & ~snapshot.occupancy
+        # 斜前方有敌方单位时可以吃掉它:
+        enemies = snapshot.occupancy & ~snapshot.occupancy_of(self.owner)
+        return result | self.shooting_mask(index, snapshot) & enemies
 
     def retrieve_valid_moves_queen(self, starting_square, snapshot):
-        squares = []
-        for x, y in self.retrieve_squares_within_shooting_range_queen(starting_square, snapshot):
-            node = snapshot.get_node(x, y)
-            if not node.unit_id or node.unit.owner != self.owner:
-                squares.append(Square(x, y))
-        return tuple(squares)
+        index = starting_square[0] + starting_square[1] * snapshot.xmax
+        mask = snapshot.tables.slide_mask(index, QUEEN_DIRECTIONS, snapshot.occupancy)
+        return snapshot.tables.squares_of(mask & ~snapshot.occupancy_of(self.owner))
+
+    def shooting_mask(self, index, snapshot):
+        """兵的攻击范围: 前方两个斜角格子(不论是否被占领)"""
+        return snapshot.tables.leap_masks(self.attack_directions)[index]
 
     def retrieve_squares_within_shooting_range(self, starting_square, snapshot):
         
-        result = []
-        dy = self.pawn_charge_direction.dy
-        for dx in {-1, 1}:
-            x, y = starting_square.x + dx, starting_square.y + dy
-            if x < 0 or x >= snapshot.xmax or y < 0 or y >= snapshot.ymax:
-                continue 
-            result.append(Square(x, y))
-        return tuple(result)
+        index = starting_square[0] + starting_square[1] * snapshot.xmax
+        return snapshot.tables.squares_of(self.shooting_mask(index, snapshot))
 
     def retrieve_squares_within_shooting_range_queen(self, starting_square, snapshot):
         
-        result = []
-        for dx, dy in self.directions:  
-            squares = []
-            step_count = 1
-            x, y = starting_square[0] + dx, starting_square[1] + dy
-            while step_count <= self.limited_move_range if self.limited_move_range > 0 else True:
-                step_count += 1
-                if x < 0 or x >= snapshot.xmax or y < 0 or y >= snapshot.ymax:
-                    break
-                node = snapshot.get_node(x, y)
-                if node.unit_id > 0:
-                    squares.append(Square(x, y))
-                    break  
-                squares.append(Square(x, y))
-                x, y = x + dx, y + dy
-            result += squares
-        return tuple(result)
-
-    def check_bottom(self,y):
-        t = self.pawn_charge_direction.dy,y
-        if t == (1,7) or t == (-1,0):
-            self.has_been_queen=True
-            self.directions = \
-                [Vector(1, 0), Vector(1, 1), Vector(0, 1), Vector(-1, 1),
-                 Vector(-1, 0), Vector(-1, -1), Vector(0, -1), Vector(1, -1)]
-            self.limited_move_range = 0  # 0 for no limit
+        index = starting_square[0] + starting_square[1] * snapshot.xmax
+        return snapshot.tables.squares_of(snapshot.tables.slide_mask(index, QUEEN_DIRECTIONS, snapshot.occupancy))
+
+    def is_bottom(self, y, ranks=8):
+        """在共 ranks 行的棋盘上, 第 y 行是否是该兵的底线(到达底线即升变)"""
+        return y == (ranks - 1 if self.pawn_charge_direction.dy > 0 else 0)
+
+    def check_bottom(self, y, ranks=8):
+        if self.is_bottom(y, ranks):
+            self.has_been_queen=True  # 升变后按 QUEEN_DIRECTIONS 不限步数移动
 
 class WhitePawnUnit(AbstractPawnUnit):
+    __slots__ = ()
+
+    attack_directions = (Vector(-1, 1), Vector(1, 1))
+    charge_direction = Vector(0, 1)
+
     @property
     def pawn_charge_direction(self):
-        return Vector(0, 1)
+        return self.charge_direction
 
 
 class BlackPawnUnit(AbstractPawnUnit):
+    __slots__ = ()
+
+    attack_directions = (Vector(-1, -1), Vector(1, -1))
+    charge_direction = Vector(0, -1)
+
     @property
     def pawn_charge_direction(self):
-        return Vector(0, -1)
+        return self.charge_direction
 
 
 class StraightMovingAndAttackingUnit(Unit):
+    __slots__ = ()
+
+    # 移动方向和步数限制(0 为不限步数)是类属性, 同类型的所有单位共用同一个元组
+    directions = ()
+    limited_move_range = 0
 
-    def __init__(self, owner):
-        super(StraightMovingAndAttackingUnit, self).__init__(owner)
-        self.directions = [] 
-        self.limited_move_range = 0  
     def retrieve_valid_moves(self, starting_square, snapshot):
-        squares = []
-        for x, y in self.retrieve_squares_within_shooting_range(starting_square, snapshot):
-            node = snapshot.get_node(x, y)
-            if not node.unit_id or node.unit.owner != self.owner:
-                squares.append(Square(x, y))
-        return tuple(squares)
+        index = starting_square[0] + starting_square[1] * snapshot.xmax
+        return snapshot.tables.squares_of(self.valid_moves_mask(index, snapshot))
+
+    def valid_moves_mask(self, index, snapshot):
+        return self.shooting_mask(index, snapshot) & ~snapshot.occupancy_of(self.owner)
+
+    def shooting_mask(self, index, snapshot):
+        """查攻击表得到攻击范围的位棋盘: 沿各方向直到(并包括)第一个被占领的格子"""
+        return snapshot.tables.shooting_mask(index, self.directions, self.limited_move_range, snapshot.occupancy)
 
     def retrieve_squares_within_shooting_range(self, starting_square, snapshot):
-        result = []
-        for dx, dy in self.directions:  
-            squares = []
-            step_count = 1
-            x, y = starting_square[0] + dx, starting_square[1] + dy
-            while step_count <= self.limited_move_range if self.limited_move_range > 0 else True:
-                step_count += 1
-                if x < 0 or x >= snapshot.xmax or y < 0 or y >= snapshot.ymax:
-                    break
-                node = snapshot.get_node(x, y)
-                if node.unit_id > 0:
-                    squares.append(Square(x, y))
-                    break  
-                squares.append(Square(x, y))
-                x, y = x + dx, y + dy
-            result += squares
-        return tuple(result)
+        index = starting_square[0] + starting_square[1] * snapshot.xmax
+        return snapshot.tables.squares_of(self.shooting_mask(index, snapshot))
 
 
 class RookUnit(StraightMovingAndAttackingUnit):
-   
+    __slots__ = ()
 
-    def __init__(self, owner):
-        super(RookUnit, self).__init__(owner)
-        self.directions = [Vector(1, 0), Vector(0, 1), Vector(-1, 0), Vector(0, -1)] 
-        self.limited_move_range = 0 
+    directions = (Vector(1, 0), Vector(0, 1), Vector(-1, 0), Vector(0, -1))
 
     def retrieve_valid_moves(self, starting_square, snapshot):
         
@@ -321,48 +1110,55 @@ class RookUnit(StraightMovingAndAttackingUnit):
 
 
 class BishopUnit(StraightMovingAndAttackingUnit):
-    def __init__(self, owner):
-        super(BishopUnit, self).__init__(owner)
-        self.directions = [Vector(1, 1), Vector(-1, 1), Vector(-1, -1), Vector(1, -1)]  
-        self.limited_move_range = 0  
+    __slots__ = ()
+
+    directions = (Vector(1, 1), Vector(-1, 1), Vector(-1, -1), Vector(1, -1))
 
 
 class QueenUnit(StraightMovingAndAttackingUnit):
+    __slots__ = ()
+
+    directions = QUEEN_DIRECTIONS
 
-    def __init__(self, owner):
-        super(QueenUnit, self).__init__(owner)
-        self.directions = \
-            [Vector(1, 0), Vector(1, 1), Vector(0, 1), Vector(-1, 1),
-             Vector(-1, 0), Vector(-1, -1), Vector(0, -1), Vector(1, -1)]
-        self.limited_move_range = 0  
 
 class KingUnit(StraightMovingAndAttackingUnit):
+    __slots__ = ()
 
-    def __init__(self, owner):
-        super(KingUnit, self).__init__(owner)
-        self.directions = \
-            [Vector(1, 0), Vector(1, 1), Vector(0, 1), Vector(-1, 1),
-             Vector(-1, 0), Vector(-1, -1), Vector(0, -1), Vector(1, -1)]
-        self.limited_move_range = 1  
+    directions = QUEEN_DIRECTIONS
+    limited_move_range = 1
 
-    def retrieve_valid_moves(self, starting_square, snapshot):
-        regular_moves = super(KingUnit, self).retrieve_valid_moves(starting_square, snapshot)
-        result = set(regular_moves)
-        del snapshot[starting_square]
-        for square, node in snapshot.items():
-            if node.unit_id and node.unit.owner != self.owner:
-                dangerous_squares = node.unit.retrieve_squares_within_shooting_range(square, snapshot)
-                result -= set(dangerous_squares)
-        return tuple(result)
+    def valid_moves_mask(self, index, snapshot):
+        result = self.shooting_mask(index, snapshot) & ~snapshot.occupancy_of(self.owner)
+        return result & ~snapshot.enemy_attacks_mask(self.owner, ignored_square=snapshot.tables.squares[index])
 
 
 class KnightUnit(StraightMovingAndAttackingUnit):
-    def __init__(self, owner):
-        super(KnightUnit, self).__init__(owner)
-        self.directions = \
-            [Vector(2, 1), Vector(1, 2), Vector(-1, 2), Vector(-2, 1),
-             Vector(-2, -1), Vector(-1, -2), Vector(1, -2), Vector(2, -1)]
-        self.limited_move_range = 1
+    __slots__ = ()
+
+    directions = (
+        Vector(2, 1), Vector(1, 2), Vector(-1, 2), Vector(-2, 1),
+        Vector(-2, -1), Vector(-1, -2), Vector(1, -2), Vector(2, -1),
+    )
+    limited_move_range = 1
+
+
+FEN_PLAYERS = (GameArena.PlayerID(1), GameArena.PlayerID(2))  # FEN 中的白方(大写字母)和黑方(小写字母)
+
+FEN_LETTERS = {
+    WhitePawnUnit: 'P',
+    BlackPawnUnit: 'P',
+    KnightUnit: 'N',
+    BishopUnit: 'B',
+    RookUnit: 'R',
+    QueenUnit: 'Q',
+    KingUnit: 'K',
+}
+
+FEN_PIECES = dict(
+    [(letter, (FEN_PLAYERS[0], unit_type)) for unit_type, letter in FEN_LETTERS.items() if unit_type is not BlackPawnUnit] +
+    [(letter.lower(), (FEN_PLAYERS[1], unit_type)) for unit_type, letter in FEN_LETTERS.items()
+     if unit_type is not WhitePawnUnit]
+)  # FEN 字母 -> (玩家, 单位类型)
 
 
 def do_self_test():
@@ -396,5 +1192,9 @@ def do_self_test():
 
 
 if '__main__' == __name__:
+    import sys
+    if sys.argv[1:]:
+        import gameheadless
+        sys.exit(gameheadless.main(sys.argv[1:]))
     do_self_test()
     pass
@@ -0,0 +1,185 @@
+# coding=utf-8
+"""用 NumPy 批量评估大量局面
+
+把 N 个同样尺寸的 GameArena 打包成形状为 (N, ranks, width) 的 int8 张量, 每个元素是该格子上棋子的编码
+(见 PIECE_CODES), 正数表示 player_id 一方的棋子, 负数表示对手的棋子, 0 表示空格. 之后子力、位置分和机动性
+都用整个张量上的向量运算一次算出, 不必逐个局面、逐个格子地循环:
+
+    boards = gamebatch.pack_arenas(arenas, player_id=white)
+    scores = gamebatch.evaluate_batch(boards)   # 形状为 (N,) 的数组, 从 white 的角度打分
+
+子力和位置分与 gameengine.evaluate() 使用同一组参数, 两者得出的分值一致; evaluate_batch() 另外加上机动性分.
+"""
+from __future__ import print_function
+
+import numpy
+
+import gamearena
+import gameengine
+
+EMPTY = 0
+PAWN_UP = 1  # 沿 y 增大的方向前进的兵(WhitePawnUnit)
+KNIGHT = 2
+BISHOP = 3
+ROOK = 4
+QUEEN = 5
+KING = 6
+PROMOTED_PAWN = 7  # 升变为后的兵
+PAWN_DOWN = 8  # 沿 y 减小的方向前进的兵(BlackPawnUnit)
+
+PIECE_CODES = {
+    gamearena.WhitePawnUnit: PAWN_UP,
+    gamearena.KnightUnit: KNIGHT,
+    gamearena.BishopUnit: BISHOP,
+    gamearena.RookUnit: ROOK,
+    gamearena.QueenUnit: QUEEN,
+    gamearena.KingUnit: KING,
+    gamearena.BlackPawnUnit: PAWN_DOWN,
+}
+
+# 编码 -> (移动方向, 是否沿方向滑动), 用于计算机动性, 兵不计机动性
+MOBILITY_DIRECTIONS = {
+    KNIGHT: (gamearena.KnightUnit.directions, False),
+    BISHOP: (gamearena.BishopUnit.directions, True),
+    ROOK: (gamearena.RookUnit.directions, True),
+    QUEEN: (gamearena.QUEEN_DIRECTIONS, True),
+    KING: (gamearena.KingUnit.directions, False),
+    PROMOTED_PAWN: (gamearena.QUEEN_DIRECTIONS, True),
+}
+MOBILITY_WEIGHT = 2  # 每个可以走到的空格的加分
+
+_CODE_COUNT = PAWN_DOWN + 1
+
+
+def encode_arena(arena, player_id=gamearena.GameArena.PlayerID(1), out=None):
+    """把 arena 的棋盘编码为形状为 (ranks, width) 的 int8 数组, 写入 out(如果给出)并返回"""
+    width, ranks = arena.size
+    if out is None:
+        out = numpy.zeros((ranks, width), dtype=numpy.int8)
+    else:
+        out[...] = EMPTY
+    flat = out.reshape(-1)
+    for index in gamearena.iterate_bits(arena.occupancy_mask()):
+        unit = arena.unit_info(arena.unit_id_at(index))
+        if isinstance(unit, gamearena.AbstractPawnUnit) and unit.has_been_queen:
+            code = PROMOTED_PAWN
+        else:
+            code = PIECE_CODES[type(unit)]
+        flat[index] = code if unit.owner == player_id else -code
+    return out
+
+
+def pack_arenas(arenas, player_id=gamearena.GameArena.PlayerID(1), size=None):
+    """把尺寸相同的若干 arena 打包成形状为 (N, ranks, width) 的 int8 张量
+
+    size 为 (width, ranks), 与 GameArena.size 相同; 省略时取第一个 arena 的尺寸, 此时 arenas 不能为空.
+    """
+    arenas = list(arenas)
+    if size is None:
+        if not arenas:
+            raise ValueError('cannot infer the board size of an empty batch, pass size=(width, ranks)')
+        size = arenas[0].size
+    width, ranks = size
+    boards = numpy.zeros((len(arenas), ranks, width), dtype=numpy.int8)
+    for board, arena in zip(boards, arenas):
+        if arena.size != (width, ranks):
+            raise ValueError('all arenas must have the same size: {} != {}'.format(arena.size, (width, ranks)))
+        encode_arena(arena, player_id, out=board)
+    return boards
+
+
+def _value_table():
+    values = numpy.zeros(_CODE_COUNT, dtype=numpy.int32)
+    for unit_type, code in PIECE_CODES.items():
+        values[code] = gameengine.UNIT_VALUES[unit_type]
+    values[PROMOTED_PAWN] = gameengine.PROMOTED_PAWN_VALUE
+    return values
+
+
+def _piece_square_table(ranks, width):
+    """形状为 (编码数, ranks, width) 的位置分表, 与 gameengine.evaluate() 的位置分一致"""
+    centrality = numpy.array(gameengine._centrality(width, ranks)).reshape(ranks, width)
+    table = numpy.zeros((_CODE_COUNT, ranks, width))
+    for unit_type, code in PIECE_CODES.items():
+        table[code] = gameengine.CENTRALITY_BONUS.get(unit_type, 0) * centrality
+    table[PROMOTED_PAWN] = gameengine.CENTRALITY_BONUS[gamearena.QueenUnit] * centrality
+    rows = numpy.arange(ranks).reshape(ranks, 1)
+    table[PAWN_UP] = gameengine.PAWN_ADVANCE_BONUS * numpy.broadcast_to(rows, (ranks, width))
+    table[PAWN_DOWN] = gameengine.PAWN_ADVANCE_BONUS * numpy.broadcast_to(ranks - 1 - rows, (ranks, width))
+    return table
+
+
+_VALUES = _value_table()
+
+
+def material(boards):
+    """每个局面的子力差, 形状为 (N,)"""
+    boards = numpy.asarray(boards)
+    values = _VALUES[numpy.abs(boards)] * numpy.sign(boards)
+    return values.sum(axis=(1, 2))
+
+
+def piece_square(boards):
+    """每个局面的位置分差, 形状为 (N,)"""
+    boards = numpy.asarray(boards)
+    n, ranks, width = boards.shape
+    table = _piece_square_table(ranks, width)
+    ys, xs = numpy.indices((ranks, width))
+    scores = table[numpy.abs(boards), ys, xs] * numpy.sign(boards)
+    return scores.sum(axis=(1, 2))
+
+
+def _shift(mask, dx, dy):
+    """result[..., y, x] = mask[..., y + dy, x + dx], 越出棋盘的部分为 False"""
+    result = numpy.zeros_like(mask)
+    ranks, width = mask.shape[-2:]
+    if abs(dx) >= width or abs(dy) >= ranks:
+        return result
+    src_y = slice(max(dy, 0), ranks + min(dy, 0))
+    dst_y = slice(max(-dy, 0), ranks + min(-dy, 0))
+    src_x = slice(max(dx, 0), width + min(dx, 0))
+    dst_x = slice(max(-dx, 0), width + min(-dx, 0))
+    result[..., dst_y, dst_x] = mask[..., src_y, src_x]
+    return result
+
+
+def mobility(boards):
+    """机动性: 每个棋子沿各方向可以走到的空格数(不计吃子和兵), 双方之差, 形状为 (N,)
+
+    滑动类棋子沿每个方向逐步延伸, 只有前面的格子都是空格时才继续计数, 所有局面和所有棋子在同一组数组运算中完成.
+    """
+    boards = numpy.asarray(boards)
+    ranks, width = boards.shape[-2:]
+    empty = boards == EMPTY
+    sign = numpy.sign(boards).astype(numpy.int32)
+    codes = numpy.abs(boards)
+    result = numpy.zeros(boards.shape[0], dtype=numpy.int32)
+    for code, (directions, sliding) in MOBILITY_DIRECTIONS.items():
+        pieces = codes == code
+        if not pieces.any():
+            continue
+        reachable = numpy.zeros(boards.shape, dtype=numpy.int32)
+        for dx, dy in directions:
+            open_ray = pieces
+            steps = max(width, ranks) if sliding else 1
+            for step in range(1, steps + 1):
+                open_ray = open_ray & _shift(empty, dx * step, dy * step)
+                if not open_ray.any():
+                    break
+                reachable += open_ray
+        result += (reachable * sign).sum(axis=(1, 2))
+    return result
+
+
+def evaluate_batch(boards, mobility_weight=MOBILITY_WEIGHT):
+    """子力 + 位置分 + 机动性, 返回形状为 (N,) 的分值数组(从编码时 player_id 一方的角度)"""
+    boards = numpy.asarray(boards)
+    scores = material(boards) + piece_square(boards)
+    if mobility_weight:
+        scores = scores + mobility_weight * mobility(boards)
+    return scores
+
+
+def evaluate_arenas(arenas, player_id=gamearena.GameArena.PlayerID(1), mobility_weight=MOBILITY_WEIGHT, size=None):
+    """pack_arenas() 与 evaluate_batch() 的组合, 方便直接传入 GameArena 列表"""
+    return evaluate_batch(pack_arenas(arenas, player_id, size), mobility_weight)
@@ -0,0 +1,303 @@
+# coding=utf-8
+"""基于 GameArena 的走棋引擎
+
+negamax + alpha-beta 剪枝, 迭代加深, 叶子节点上只展开吃子走法的静态搜索(quiescence), 用置换表排序走法并给出主要变例.
+局面评估只考虑子力价值和简单的位置分(越靠近中心越好, 兵越往前越好).
+
+搜索受 time_limit(秒)和 node_limit 两种预算约束, 任何一种预算用完都会立即停止, 并返回最后一轮完整搜索的结果,
+因此每步棋的耗时是可以预期的:
+
+    engine = gameengine.Engine(arena)
+    result = engine.search(max_depth=6, time_limit=0.5)
+    arena.make_move(result.best_move)
+
+由于规则中国王可能被吃掉, 失去国王的一方判负, 分值为 -MATE_SCORE(加上已经走过的步数).
+"""
+from __future__ import print_function
+
+import collections
+import time
+
+import gamearena
+
+MATE_SCORE = 100000
+MATE_BOUND = MATE_SCORE - 1000  # 绝对值不小于它的分值表示若干步之内分出胜负
+
+# 每搜索这么多个节点检查一次时钟和停止信号. 静态搜索的节点很贵(每个节点都要生成走法和评估局面),
+# 间隔太大会让 time_limit 明显超时; 2 的幂便于用位运算判断
+TIME_CHECK_INTERVAL = 64
+
+UNIT_VALUES = {
+    gamearena.WhitePawnUnit: 100,
+    gamearena.BlackPawnUnit: 100,
+    gamearena.KnightUnit: 320,
+    gamearena.BishopUnit: 330,
+    gamearena.RookUnit: 500,
+    gamearena.QueenUnit: 900,
+    gamearena.KingUnit: 0,  # 国王不计子力, 失去国王直接判负
+}
+PROMOTED_PAWN_VALUE = UNIT_VALUES[gamearena.QueenUnit]
+
+# 位置分: 每接近中心一格的加分(国王为负数, 开局和中局应当留在后方)
+CENTRALITY_BONUS = {
+    gamearena.KnightUnit: 10,
+    gamearena.BishopUnit: 5,
+    gamearena.RookUnit: 0,
+    gamearena.QueenUnit: 2,
+    gamearena.KingUnit: -5,
+}
+PAWN_ADVANCE_BONUS = 8  # 兵每前进一行的加分
+
+SearchResult = collections.namedtuple('SearchResult', ['best_move', 'score', 'depth', 'pv', 'nodes', 'seconds'])
+
+
+class SearchAborted(Exception):
+    """时间或节点预算用完"""
+    pass
+
+
+def _centrality(width, ranks, cache={}):
+    """每个格子离棋盘边缘的远近程度, 角上为 0, 越靠近中心越大"""
+    try:
+        return cache[width, ranks]
+    except KeyError:
+        pass
+    half = min(width, ranks) / 2.0 - 0.5
+    cx, cy = (width - 1) / 2.0, (ranks - 1) / 2.0
+    table = cache[width, ranks] = tuple(
+        half - max(abs(i % width - cx), abs(i // width - cy)) for i in range(width * ranks))
+    return table
+
+
+def evaluate(arena, player_id):
+    """从 player_id 一方的角度评估局面(子力 + 位置分), 分值越大对 player_id 越有利"""
+    width, ranks = arena.size
+    centrality = _centrality(width, ranks)
+    score = 0
+    for index in gamearena.iterate_bits(arena.occupancy_mask()):
+        unit = arena.unit_info(arena.unit_id_at(index))
+        unit_type = type(unit)
+        if isinstance(unit, gamearena.AbstractPawnUnit):
+            if unit.has_been_queen:
+                value = PROMOTED_PAWN_VALUE + CENTRALITY_BONUS[gamearena.QueenUnit] * centrality[index]
+            else:
+                y = index // width
+                advanced = y if unit.pawn_charge_direction.dy > 0 else ranks - 1 - y
+                value = UNIT_VALUES[unit_type] + PAWN_ADVANCE_BONUS * advanced
+        else:
+            value = UNIT_VALUES.get(unit_type, 0) + CENTRALITY_BONUS.get(unit_type, 0) * centrality[index]
+        score += value if unit.owner == player_id else -value
+    return int(score)
+
+
+def _score_to_table(score, ply):
+    """置换表中的杀棋分值按"从该局面起还有几步分出胜负"记录, 与局面出现在搜索树的第几层无关"""
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def _score_from_table(score, ply):
+    """_score_to_table() 的逆运算: 换算回以根节点为起点的杀棋分值"""
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+
+class Engine(object):
+    def __init__(self, arena, table=None):
+        self.arena = arena
+        self.table = table if table is not None else gamearena.TranspositionTable(1 << 16)
+        self.nodes = 0
+        self.__deadline = None
+        self.__node_limit = None
+        self.__stop = None
+        self.__killers = {}  # 层数 -> 在该层引起剪枝的非吃子走法
+        self.__royal_players = set()  # 搜索开始时拥有国王的玩家, 搜索中失去国王即判负
+
+    def search(self, max_depth=64, time_limit=None, node_limit=None, root_moves=None, stop=None):
+        """迭代加深搜索, 返回 SearchResult(最佳走法, 分值, 完成的深度, 主要变例, 节点数, 耗时)
+
+        没有任何走法时 best_move 为 None. 预算在第一轮搜索完成之前就已用完时, 返回按走法排序得到的第一个走法.
+        root_moves 指定根节点只搜索哪些走法(分值相同的走法按给定的顺序排列), stop 是一个无参数的函数,
+        返回 True 时像预算用完一样停止搜索(供多进程并行搜索使用).
+        """
+        arena = self.arena
+        started = time.time()
+        self.nodes = 0
+        self.__deadline = started + time_limit if time_limit is not None else None
+        self.__node_limit = node_limit
+        self.__stop = stop
+        self.__killers = {}
+        self.__royal_players = set(arena.owner_of_unit(arena.unit_id_at(i))
+                                   for i in gamearena.iterate_bits(arena.unit_type_mask(gamearena.KingUnit)))
+        root_depth = arena.undo_depth
+        moves = list(arena.generate_moves()) if root_moves is None else list(root_moves)
+        if not moves:
+            return SearchResult(None, self.__terminal_score(0), 0, (), 0, time.time() - started)
+        best = SearchResult(self.__order(moves, 0, 0)[0], 0, 0, (), 0, 0.0)
+        for depth in range(1, max_depth + 1):
+            try:
+                score, move = self.__root(moves, depth)
+            except SearchAborted:
+                while arena.undo_depth > root_depth:
+                    arena.unmake_move()
+                break
+            pv = self.principal_variation(depth)
+            best = SearchResult(move, score, depth, pv, self.nodes, time.time() - started)
+            if abs(score) >= MATE_BOUND:
+                break  # 已经找到杀着, 继续加深没有意义
+        return best._replace(nodes=self.nodes, seconds=time.time() - started)
+
+    def principal_variation(self, max_length):
+        """沿置换表中记录的最佳走法走下去得到主要变例"""
+        arena = self.arena
+        pv = []
+        seen = set()
+        while len(pv) < max_length and arena.zobrist_key not in seen:
+            seen.add(arena.zobrist_key)
+            entry = self.table.probe(arena.zobrist_key)
+            if entry is None or not entry[2] or entry[2] not in arena.generate_moves():
+                break
+            pv.append(entry[2])
+            arena.make_move(entry[2])
+        for _ in pv:
+            arena.unmake_move()
+        return tuple(pv)
+
+    def __root(self, moves, depth):
+        arena = self.arena
+        alpha, beta = -MATE_SCORE - 1, MATE_SCORE + 1
+        best_move = None
+        tt_move = self.__tt_move(arena.zobrist_key)
+        for move in self.__order(moves, tt_move, 0):
+            arena.make_move(move)
+            score = -self.__negamax(depth - 1, -beta, -alpha, 1)
+            arena.unmake_move()
+            if best_move is None or score > alpha:
+                alpha, best_move = score, move
+        self.table.store(arena.zobrist_key, depth, alpha, best_move, gamearena.TranspositionTable.EXACT)
+        return alpha, best_move
+
+    def __negamax(self, depth, alpha, beta, ply):
+        arena = self.arena
+        self.__count_node()
+        if self.__has_lost_king(arena.side_to_move):
+            return -MATE_SCORE + ply
+        if depth <= 0:
+            return self.__quiescence(alpha, beta, ply)
+        key = arena.zobrist_key
+        table = self.table
+        entry = table.probe(key)
+        tt_move = 0
+        if entry is not None:
+            entry_depth, value, tt_move, bound = entry
+            value = _score_from_table(value, ply)
+            if entry_depth >= depth:
+                if bound == table.EXACT:
+                    return value
+                if bound == table.LOWER_BOUND and value >= beta:
+                    return value
+                if bound == table.UPPER_BOUND and value <= alpha:
+                    return value
+        moves = arena.generate_moves()
+        if not moves:
+            return self.__terminal_score(ply)
+        original_alpha = alpha
+        best_score, best_move = -MATE_SCORE - 1, 0
+        for move in self.__order(moves, tt_move, ply):
+            arena.make_move(move)
+            score = -self.__negamax(depth - 1, -beta, -alpha, ply + 1)
+            arena.unmake_move()
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        if not move >> 2 * gamearena.MOVE_SQUARE_BITS & gamearena.MOVE_FLAG_CAPTURE:
+                            self.__killers[ply] = move
+                        break
+        if best_score <= original_alpha:
+            bound = table.UPPER_BOUND
+        elif best_score >= beta:
+            bound = table.LOWER_BOUND
+        else:
+            bound = table.EXACT
+        table.store(key, depth, _score_to_table(best_score, ply), best_move, bound)
+        return best_score
+
+    def __quiescence(self, alpha, beta, ply):
+        """只展开吃子走法, 直到局面平静下来再评估, 避免在交换吃子的中途得出错误的结论"""
+        arena = self.arena
+        stand_pat = evaluate(arena, arena.side_to_move)
+        if stand_pat >= beta:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+        flag_shift = 2 * gamearena.MOVE_SQUARE_BITS
+        captures = [m for m in arena.generate_moves() if m >> flag_shift & gamearena.MOVE_FLAG_CAPTURE]
+        for move in self.__order(captures, 0, ply):
+            self.__count_node()
+            arena.make_move(move)
+            if self.__has_lost_king(arena.side_to_move):
+                score = MATE_SCORE - ply - 1
+            else:
+                score = -self.__quiescence(-beta, -alpha, ply + 1)
+            arena.unmake_move()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def __order(self, moves, tt_move, ply):
+        """置换表走法最先, 其次是吃子(先吃价值高的子, 再用价值低的子去吃), 然后是杀手走法, 最后是其他走法"""
+        arena = self.arena
+        killer = self.__killers.get(ply)
+        flag_shift = 2 * gamearena.MOVE_SQUARE_BITS
+        square_mask = gamearena.MOVE_SQUARE_MASK
+
+        def priority(move):
+            if move == tt_move:
+                return -10 ** 9
+            if move >> flag_shift & gamearena.MOVE_FLAG_CAPTURE:
+                victim = arena.unit_info(arena.unit_id_at(move >> gamearena.MOVE_SQUARE_BITS & square_mask))
+                attacker = arena.unit_info(arena.unit_id_at(move & square_mask))
+                victim_value = UNIT_VALUES.get(type(victim), 0) or MATE_SCORE
+                return -10 * victim_value + UNIT_VALUES.get(type(attacker), 0) // 100
+            if move >> flag_shift & gamearena.MOVE_FLAG_PROMOTION:
+                return -1
+            if move == killer:
+                return 0
+            return 1
+
+        return sorted(moves, key=priority)
+
+    def __tt_move(self, key):
+        entry = self.table.probe(key)
+        return entry[2] if entry is not None else 0
+
+    def __has_lost_king(self, player_id):
+        if player_id not in self.__royal_players:
+            return False
+        return not self.arena.unit_type_mask(gamearena.KingUnit) & self.arena.occupancy_mask(player_id)
+
+    def __terminal_score(self, ply):
+        """无子可走: 国王被将军时判负, 否则为和棋"""
+        if self.arena.is_in_check(self.arena.side_to_move):
+            return -MATE_SCORE + ply
+        return 0
+
+    def __count_node(self):
+        self.nodes += 1
+        if self.nodes & (TIME_CHECK_INTERVAL - 1) == 0:
+            if self.__deadline is not None and time.time() >= self.__deadline:
+                raise SearchAborted()
+            if self.__stop is not None and self.__stop():
+                raise SearchAborted()
+        if self.__node_limit is not None and self.nodes >= self.__node_limit:
+            raise SearchAborted()
@@ -4,6 +4,8 @@ from __future__ import print_function
 
 import sys
 import math
+import argparse
+import array
 import panda3d.core
 import direct.showbase.ShowBase
 import direct.gui.OnscreenText
@@ -11,6 +13,7 @@ import direct.task.Task
 import direct.interval.LerpInterval
 import direct.gui.DirectCheckButton
 import gamearena
+import gamemodels
 
 
 class IllegalMoveException(Exception):
@@ -18,9 +21,12 @@ class IllegalMoveException(Exception):
 
 
 class MyChessboard(direct.showbase.ShowBase.ShowBase):
-    def __init__(self, fStartDirect=True, windowType=None):
+    def __init__(self, fStartDirect=True, windowType=None, instancedPieces=None):
         direct.showbase.ShowBase.ShowBase.__init__(self, fStartDirect=fStartDirect, windowType=windowType)
         self.disableMouse()
+        if instancedPieces is None:
+            instancedPieces = INSTANCED_PIECES.getValue()
+        self.__instancedPieces = instancedPieces  # 为 True 时用 InstancedPieceRenderer 绘制棋子, 每种棋子一次绘制调用
 
         self.__picker = panda3d.core.CollisionTraverser()
         self.__handler = panda3d.core.CollisionHandlerQueue()
@@ -40,19 +46,14 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         self.__chessboardTopCenter = self.render.attachNewNode("chessboardTopCenter")  # 定位棋盘顶面的中心位置
         self.__pieceRoot = self.__chessboardTopCenter.attachNewNode("pieceRoot")  # 虚拟根节点用于归纳棋子对象
         self.__chessboard = self.__defaultChessboard(self.__chessboardTopCenter, self.__pieceRoot)
-        squares = self.__chessboard['squares']  # 后面会通过变量 squares[i] 查询 64 个棋盘方格空间位置并挂载全部棋子模型
-
-        # 载入棋子模型
-        white_piece_model = self.__selectChessPieceModelSytle('models/default')
-        black_piece_model = self.__selectChessPieceModelSytle('models/default')
-        name_order = ['rook', 'knight', 'bishop', 'queen', 'king', 'bishop', 'knight', 'rook']
-        colors = {
-            'WHITE': (1.000, 1.000, 1.000, 1),  # RGB color for WHITE pieces
-            'BLACK': (0.150, 0.150, 0.150, 1),  # RGB color for BLACK pieces
-        }
 
         # 利用 GameArena() 进行沙盘推演，是为了检查每个棋子的走法是否符合国际象棋规则
         self.arena = gamearena.GameArena(8, 8)
+        # 棋盘状态的索引镜像, 完全由 arena 的变化通知(__onArenaChanged)维护, 查询时不必扫描整个棋盘
+        self.__unitOnSquare = [0] * 64  # 方格编号 -> 单位编码, 空格为 0
+        self.__squareOfUnit = {}  # 单位编码 -> 方格编号, 已被吃掉的单位为 None
+        self.__movedUnits = set()  # 位置发生了变化、3D 模型尚未跟着移动的单位
+        self.arena.add_change_listener(self.__onArenaChanged)
         unit_types_without_pawn = [
             ('king', gamearena.KingUnit),
             ('queen', gamearena.QueenUnit),
@@ -64,44 +65,21 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         black_unit_type_list = dict(unit_types_without_pawn + [('pawn', gamearena.BlackPawnUnit)])
         white_player = gamearena.GameArena.PlayerID(1)
         black_player = gamearena.GameArena.PlayerID(2)
+        name_order = ['rook', 'knight', 'bishop', 'queen', 'king', 'bishop', 'knight', 'rook']
 
-        # 创建模型实例
+        # 先在 Arena 中建立双方的棋子, 3D 模型在后台载入完成后再按 self.__startingPieces 实例化
         # 双方各 16 个棋子: 白棋棋子位于 _square[0]~[15], 黑棋位于 _square[48]~[63]
-        pieces_sorted_by_square = [None] * 64
-        piece_id_sorted_by_square = [0] * 64
-        pieces_sorted_by_id = {}
+        self.__startingPieces = []  # [(方格编号, 模型名称, 单位编码, 'WHITE' 或 'BLACK'), ...]
         for i, name in zip(range(16), name_order + ['pawn'] * 8):
-            # 实例化棋子的 3D 模型(初始定位到棋盘方格模型的上方)
-            piece_holder = squares[i].attachNewNode("pieceInstanceHolder")
-            piece_holder.setColor(colors['WHITE'])
-            white_piece_model[name].instanceTo(piece_holder)
-            # Arena 中的对应点位建立相同的棋子:
             point = (i % 8, i // 8)
             pid = self.arena.new_unit_recruited_by_player(white_player, point, white_unit_type_list[name])
-            piece_id_sorted_by_square[i] = pid
-            piece = CustomizedPiece(piece_holder, mask=panda3d.core.BitMask32.bit(1))
-            piece.setTag('piece', str(pid))
-            pieces_sorted_by_square[i] = piece
-            pieces_sorted_by_id[pid] = piece
+            self.__startingPieces.append((i, name, pid, 'WHITE'))
         for i, name in zip(range(64 - 16, 64), ['pawn'] * 8 + name_order):
-
-            piece_holder = squares[i].attachNewNode("pieceInstanceHolder")
-            piece_holder.setColor(colors['BLACK'])
-            piece_holder.setH(180)  
-            black_piece_model[name].instanceTo(piece_holder)
-
             point = (i % 8, i // 8)
             pid = self.arena.new_unit_recruited_by_player(black_player, point, black_unit_type_list[name])
-            piece_id_sorted_by_square[i] = pid
-            piece = CustomizedPiece(piece_holder, mask=panda3d.core.BitMask32.bit(1))
-            piece.setTag('piece', str(pid))
-            pieces_sorted_by_square[i] = piece
-            pieces_sorted_by_id[pid] = piece
-
-
-        self.__pieceOnSquare = pieces_sorted_by_square
-        self.__pieces = pieces_sorted_by_id
-        self.__pidOnSquare = piece_id_sorted_by_square
+            self.__startingPieces.append((i, name, pid, 'BLACK'))
+        self.__pieces = {}
+        self.__movedUnits.clear()  # 棋子模型实例化时就放在各自的方格上
 
         self.__graveyard = self.__defaultGraveyard() 
         self.__pointingTo = 0 
@@ -109,13 +87,11 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         self.__finger = self.__pieceRoot.attachNewNode('fingerTouching')
         self.__mouse3 = None 
         self.__hsymbol = 1
+        self.__lastMouseState = None  # 上一帧的鼠标位置、摄像机姿态、拖动状态和棋盘版本号
 
-        self.taskMgr.add(self.mouseTask, 'MouseTask')
         self.accept('escape', sys.exit) 
-        self.accept("mouse1", self.onMouse1Pressed)  
-        self.accept("mouse1-up", self.onMouse1Released) 
-        self.accept("mouse3", self.onMouse3Pressed)
-        self.accept("mouse3-up", self.onMouse3Released)
+        # 棋子模型载入之前不响应鼠标, 载入完成后由 __onPieceModelsLoaded() 注册鼠标事件
+        self.__selectChessPieceModelSytle('models/default')
 
         self.axisCameraPitching = self.render.attachNewNode("axisCameraPitching")  
         self.axisCameraPitching.setHpr(h=0, p=-45, r=0)  
@@ -151,28 +127,59 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         return labels
 
     def mouseTask(self, task):
-        """mouseTask deals with the highlighting and dragging based on the mouse"""
+        """mouseTask deals with the highlighting and dragging based on the mouse
+
+        鼠标位置、摄像机、拖动状态和棋盘都没有变化时沿用上一帧的结果, 不做任何碰撞检测.
+        鼠标指向的方格由射线与棋盘平面的交点直接算出, 只有判断是否指向棋子时才需要遍历碰撞体.
+        """
 
         marks = self.__chessboard['marks']
-        squareRoot = self.__chessboard['squareRoot']
 
+        if self.mouseWatcherNode is None or not self.mouseWatcherNode.hasMouse():  # 离屏窗口没有鼠标
+            self.__clearPointing(marks)
+            self.__lastMouseState = None
+            return direct.task.Task.cont
+
+        mpos = self.mouseWatcherNode.getMouse()
+        state = (mpos.getX(), mpos.getY(), self.axisCameraPitching.getH(), self.axisCameraPitching.getP(),
+                 self.camera.getY(), self.__dragging, self.arena.version)
+        if state != self.__lastMouseState:
+            self.__lastMouseState = state
+            self.__clearPointing(marks)
+            self.__updatePointing(mpos)
+            if self.__pointingTo:
+                i = self.__pointingTo - 1
+                if self.__dragging:
+                    marks.setScale(i, 1.02)
+                    marks.show(i)
+                if self.__hasPieceOnSquare(i):
+                    if not self.__dragging or (self.__dragging and self.__pointingTo != self.__dragging):
+                        self.__pieceOnSquare(i).showBounds()
+        if self.__mouse3:
+            fold = 50
+            h = self.__mouse3[2] + self.__hsymbol*fold*(self.__mouse3[0] - mpos.getX())
+            p = self.__mouse3[3] - fold*(self.__mouse3[1] - mpos.getY())
+            self.axisCameraPitching.setH(h)
+            if p < 0 and p > -90:
+                self.axisCameraPitching.setP(p)
+            h_symbol =  1 if mpos.getY() <=0 else -1
+            if h_symbol!=self.__hsymbol:
+                self.__mouse3 = (mpos.getX(),mpos.getY(),self.axisCameraPitching.getH(),self.axisCameraPitching.getP())
+                self.__hsymbol = h_symbol
+        return direct.task.Task.cont
 
+    def __clearPointing(self, marks):
         if self.__pointingTo:
             i = self.__pointingTo - 1
-            marks[i].setScale(0.75)
+            marks.setScale(i, 0.75)
             if not self.__marksAlwaysVisible or not (i in self.__validMarks):
-                marks[i].hide()
+                marks.hide(i)
             if self.__hasPieceOnSquare(i):
-                self.__pieceOnSquare[i].hideBounds()
+                self.__pieceOnSquare(i).hideBounds()
             self.__pointingTo = False
 
-
-        if not self.mouseWatcherNode.hasMouse():
-            return direct.task.Task.cont
-
-
-        mpos = self.mouseWatcherNode.getMouse()
-
+    def __updatePointing(self, mpos):
+        """移动手指(拖动棋子的挂载点)到鼠标射线与棋盘平面的交点, 并找出鼠标指向的方格"""
         self.__pickerRay.setFromLens(self.camNode, mpos.getX(), mpos.getY())
 
         p = self.render.getRelativePoint(self.camera, self.__pickerRay.getOrigin())
@@ -184,82 +191,51 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         self.__finger.setPos(x, y, z)
 
         if self.__dragging:
-
-            i = self.__dragging - 1
-            piece = self.__pieceOnSquare[i]
-            piece.picker.traverse(squareRoot) 
-            if piece.handler.getNumEntries() > 0:
-                piece.handler.sortEntries()
-                entry = piece.handler.getEntry(0)
-                tag = 'square'
-                value = entry.getIntoNode().getTag(tag)
-                i = int(value)
-                self.__pointingTo = i + 1
-        else:
-            self.__picker.traverse(self.__pieceRoot)  
-            if self.__handler.getNumEntries() > 0:
-                self.__handler.sortEntries()
-                entry = self.__handler.getEntry(0)
-                tag = 'piece'
-                value = entry.getIntoNode().getTag(tag)
-                try:
-                    piece_id = int(value)
-                except ValueError:
-                    pass  # Ignore this case
-                else:
-                    for i, pid in enumerate(self.__pidOnSquare):
-                        if pid == piece_id:
-                            self.__pointingTo = i + 1
-                            break
+            # 被拖动的棋子正下方的方格
+            pos = self.__pieceOnSquare(self.__dragging - 1).getPos(self.__chessboardTopCenter)
+            self.__pointingTo = MyChessboard.__squareAt(pos.getX(), pos.getY())
+            return
+        # 棋子比方格高, 可能挡住后面的方格, 所以先用射线检测是否指向某个棋子
+        self.__picker.traverse(self.__pieceRoot)  
+        if self.__handler.getNumEntries() > 0:
+            self.__handler.sortEntries()
+            entry = self.__handler.getEntry(0)
+            tag = 'piece'
+            value = entry.getIntoNode().getTag(tag)
+            try:
+                piece_id = int(value)
+            except ValueError:
+                pass  # Ignore this case
             else:
-                self.__picker.traverse(squareRoot)
-                if self.__handler.getNumEntries() > 0:
-                    self.__handler.sortEntries()
-                    entry = self.__handler.getEntry(0)
-                    tag = 'square'
-                    value = entry.getIntoNode().getTag(tag)
-                    i = int(value)
+                i = self.__squareOfUnit.get(piece_id)
+                if i is not None:
                     self.__pointingTo = i + 1
+                    return
+        self.__pointingTo = MyChessboard.__squareAt(x, y)
 
-        if self.__pointingTo:
-            i = self.__pointingTo - 1
-            if self.__dragging:
-                marks[i].setScale(1.02)
-                marks[i].show()
-            if self.__hasPieceOnSquare(i):
-                if not self.__dragging or (self.__dragging and self.__pointingTo != self.__dragging):
-                    self.__pieceOnSquare[i].showBounds()
-        if self.__mouse3:
-            fold = 50
-            h = self.__mouse3[2] + self.__hsymbol*fold*(self.__mouse3[0] - mpos.getX())
-            p = self.__mouse3[3] - fold*(self.__mouse3[1] - mpos.getY())
-            self.axisCameraPitching.setH(h)
-            if p < 0 and p > -90:
-                self.axisCameraPitching.setP(p)
-            h_symbol =  1 if mpos.getY() <=0 else -1
-            if h_symbol!=self.__hsymbol:
-                self.__mouse3 = (mpos.getX(),mpos.getY(),self.axisCameraPitching.getH(),self.axisCameraPitching.getP())
-                self.__hsymbol = h_symbol
-        return direct.task.Task.cont
+    @staticmethod
+    def __squareAt(x, y):
+        """__squarePos() 的逆运算: 棋盘平面上的一点所在方格的编号加一, 不在棋盘上时为 0"""
+        column = int(math.floor(x + 4))
+        row = int(math.floor(y + 4))
+        if 0 <= column < 8 and 0 <= row < 8:
+            return column + row * 8 + 1
+        return 0
 
     def __defaultChessboard(self, chessboardTopCenter, pieceRoot):
+        """棋盘方格和走法标记各自只是一个程序生成的网格, 整个棋盘只需要两次绘制调用
+
+        方格的黑白两色写在顶点颜色里; 标记的颜色、大小和是否可见由 ChessboardMarks 改写对应方格的 4 个顶点.
+        鼠标指向的方格由射线与棋盘平面的交点直接算出(见 __squareAt()), 棋盘不需要碰撞体.
+        """
         squareRoot = chessboardTopCenter.attachNewNode("squareRoot")
 
         white = (1, 1, 1, 1)
         black = (0.3, 0.3, 0.3, 1)
         colors = {1: white, 0: black}
+        squareColors = [colors[(i // 8 + i) % 2] for i in range(64)]
+        squareRoot.attachNewNode(makeSquaresGeomNode('chessboardSquares', squareColors))
 
-        # For each square
-        squares = []
-        for i in range(64):
-            row = i // 8
-            color = colors[(row + i) % 2]
-            square = self.loader.loadModel("models/square")
-            square.setColor(color)
-            square.reparentTo(squareRoot)
-            square.setPos(MyChessboard.__squarePos(i))
-            square.find("**/polygon").node().setIntoCollideMask(panda3d.core.BitMask32.bit(1))
-            square.find("**/polygon").node().setTag('square', str(i))
         self.__marksAlwaysVisible = True  
         self.__checkButton = direct.gui.DirectCheckButton.DirectCheckButton(
             pos=(1.0, 0.0, 0.85),
@@ -274,21 +250,13 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
             command=self.toggleChessboardMarksBehavior
         )
         self.__validMarks = set()
-        mark = self.loader.loadModel("models/square")
-        mark.setTransparency(panda3d.core.TransparencyAttrib.MDual)
-        marks = []
+        marks = ChessboardMarks(chessboardTopCenter, z=1E-2)
+
+        # 棋子模型挂载在 pieceRoot 下的 64 个空节点上, 这些节点不参与绘制
+        squares = []
         for i in range(64):
-            pos = MyChessboard.__squarePos(i)
-            holder = chessboardTopCenter.attachNewNode("markInstanceHolder")
-            mark.instanceTo(holder)
-            pos.setZ(pos.getZ() + 1E-2)  
-            holder.setPos(pos)
-            holder.setColor(MarkColor['UNACCEPTABLE_MOVE'])
-            holder.setScale(0.75)
-            holder.hide()
-            marks.append(holder)
             square = pieceRoot.attachNewNode("square")
-            square.setPos(pos)
+            square.setPos(MyChessboard.__squarePos(i))
             squares.append(square)  
 
         return {'squares': squares, 'marks': marks, 'squareRoot': squareRoot}
@@ -300,7 +268,36 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         :rtype : bool
         """
         assert 0 <= i < 64
-        return bool(self.__pieceOnSquare[i])
+        return bool(self.__unitOnSquare[i])
+
+    def __pieceOnSquare(self, i):
+        """编号为 i 的方格上的棋子模型, 空格返回 None"""
+        return self.__pieces.get(self.__unitOnSquare[i])
+
+    def __onArenaChanged(self, unit_id, old_index, new_index):
+        """arena 的变化通知: 更新棋盘状态镜像, 并记下 3D 模型需要跟着移动的单位"""
+        if old_index is not None and self.__unitOnSquare[old_index] == unit_id:
+            self.__unitOnSquare[old_index] = 0
+        if new_index is not None:
+            self.__unitOnSquare[new_index] = unit_id
+        self.__squareOfUnit[unit_id] = new_index
+        self.__movedUnits.add(unit_id)
+
+    def __applyArenaChanges(self):
+        """按镜像把位置发生了变化的单位的 3D 模型放到新的方格上, 被吃掉的送进墓地"""
+        squares = self.__chessboard['squares']
+        for unit_id in self.__movedUnits:
+            piece = self.__pieces[unit_id]
+            i = self.__squareOfUnit[unit_id]
+            if i is None:
+                self.__sendToGraveyard(piece=piece, gid=unit_id)
+                continue
+            piece.reparentTo(squares[i])
+            piece.setX(0)
+            piece.setY(0)
+            piece.stop('hovering')
+            piece.play('landing')
+        self.__movedUnits.clear()
 
     def onMouse1Pressed(self):
 
@@ -309,16 +306,16 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
                 return
 
             i = self.__dragging - 1
-            self.__pieceOnSquare[i].reparentTo(self.__chessboard['squares'][i]) 
-            self.__pieceOnSquare[i].setX(0)
-            self.__pieceOnSquare[i].setY(0)
-            self.__pieceOnSquare[i].stop('hovering')
-            self.__pieceOnSquare[i].play('landing')
+            self.__pieceOnSquare(i).reparentTo(self.__chessboard['squares'][i]) 
+            self.__pieceOnSquare(i).setX(0)
+            self.__pieceOnSquare(i).setY(0)
+            self.__pieceOnSquare(i).stop('hovering')
+            self.__pieceOnSquare(i).play('landing')
             self.__dragging = False
             if self.__marksAlwaysVisible:
                 marks = self.__chessboard['marks']
                 for i in self.__validMarks:
-                    marks[i].hide()
+                    marks.hide(i)
             return
         if not self.__dragging:
             if self.__hasPieceOnSquare(self.__pointingTo - 1): 
@@ -327,82 +324,82 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
                 squarePos = self.__chessboard['squares'][i].getPos()
                 x = squarePos.getX() - self.__finger.getX()
                 y = squarePos.getY() - self.__finger.getY()
-                self.__pieceOnSquare[i].reparentTo(self.__finger)  
-                self.__pieceOnSquare[i].setPos(x, y, 0)
-                self.__pieceOnSquare[i].play('hovering')
-                destinations = mark_indexes_from_coordinates(
-                    self.arena.retrieve_valid_moves_of_unit(unit_id=self.__pidOnSquare[i])
-                )
+                self.__pieceOnSquare(i).reparentTo(self.__finger)  
+                self.__pieceOnSquare(i).setPos(x, y, 0)
+                self.__pieceOnSquare(i).play('hovering')
+                destinations = tuple(gamearena.iterate_bits(
+                    self.arena.valid_moves_mask_of_unit(self.__unitOnSquare[i])
+                ))
                 current = {i}
                 previous = self.__validMarks
                 self.__validMarks = set(destinations) | current
                 marks = self.__chessboard['marks']
-                marks[i].setColor(MarkColor['STARTING_POINT'])
+                marks.setColor(i, MarkColor['STARTING_POINT'])
                 for tmp in previous - self.__validMarks:
-                    marks[tmp].setColor(MarkColor['UNACCEPTABLE_MOVE'])
+                    marks.setColor(tmp, MarkColor['UNACCEPTABLE_MOVE'])
                 for tmp in destinations:
-                    marks[tmp].setColor(MarkColor['ACCEPTABLE_MOVE'])
+                    marks.setColor(tmp, MarkColor['ACCEPTABLE_MOVE'])
                 if self.__marksAlwaysVisible:
                     for tmp in self.__validMarks:
-                        marks[tmp].show()
+                        marks.show(tmp)
             return
 
         if self.__pointingTo != self.__dragging:
             i2 = self.__pointingTo - 1
             if self.__hasPieceOnSquare(i2):
-                piece2_id = self.__pidOnSquare[i2]
+                piece2_id = self.__unitOnSquare[i2]
                 owner2 = self.arena.owner_of_unit(piece2_id)
                 i1 = self.__dragging - 1
-                piece1_id = self.__pidOnSquare[i1]
+                piece1_id = self.__unitOnSquare[i1]
                 owner1 = self.arena.owner_of_unit(piece1_id)
                 if owner2 == owner1:  
                     k1 = self.__dragging - 1
-                    self.__pieceOnSquare[k1].reparentTo(self.__chessboard['squares'][k1])  
-                    self.__pieceOnSquare[k1].setX(0)
-                    self.__pieceOnSquare[k1].setY(0)
-                    self.__pieceOnSquare[k1].stop('hovering')
-                    self.__pieceOnSquare[k1].play('landing')
+                    self.__pieceOnSquare(k1).reparentTo(self.__chessboard['squares'][k1])  
+                    self.__pieceOnSquare(k1).setX(0)
+                    self.__pieceOnSquare(k1).setY(0)
+                    self.__pieceOnSquare(k1).stop('hovering')
+                    self.__pieceOnSquare(k1).play('landing')
                     if self.__marksAlwaysVisible:
                         marks = self.__chessboard['marks']
                         for i in self.__validMarks:
-                            marks[i].hide()
+                            marks.hide(i)
                     self.__dragging = self.__pointingTo
                     k2 = self.__dragging - 1
                     squarePos = self.__chessboard['squares'][k2].getPos()
                     x = squarePos.getX() - self.__finger.getX()
                     y = squarePos.getY() - self.__finger.getY()
-                    self.__pieceOnSquare[k2].setPos(x, y, 0)
-                    self.__pieceOnSquare[k2].play('hovering')
-                    destinations = mark_indexes_from_coordinates(
-                        self.arena.retrieve_valid_moves_of_unit(unit_id=self.__pidOnSquare[k2])
-                    )
+                    self.__pieceOnSquare(k2).setPos(x, y, 0)
+                    self.__pieceOnSquare(k2).play('hovering')
+                    destinations = tuple(gamearena.iterate_bits(
+                        self.arena.valid_moves_mask_of_unit(self.__unitOnSquare[k2])
+                    ))
                     current = {k2}
                     previous = self.__validMarks
                     self.__validMarks = set(destinations) | current
                     marks = self.__chessboard['marks']
-                    marks[k2].setColor(MarkColor['STARTING_POINT'])
+                    marks.setColor(k2, MarkColor['STARTING_POINT'])
                     for tmp in previous - self.__validMarks:
-                        marks[tmp].setColor(MarkColor['UNACCEPTABLE_MOVE'])
+                        marks.setColor(tmp, MarkColor['UNACCEPTABLE_MOVE'])
                     for tmp in destinations:
-                        marks[tmp].setColor(MarkColor['ACCEPTABLE_MOVE'])
+                        marks.setColor(tmp, MarkColor['ACCEPTABLE_MOVE'])
                     if self.__marksAlwaysVisible:
                         for tmp in self.__validMarks:
-                            marks[tmp].show()
+                            marks.show(tmp)
             j = self.__dragging - 1
-            self.__pieceOnSquare[j].reparentTo(self.__finger) 
+            self.__pieceOnSquare(j).reparentTo(self.__finger) 
             return
 
         k = self.__dragging - 1
-        self.__pieceOnSquare[k].reparentTo(self.__chessboard['squares'][k])
-        self.__pieceOnSquare[k].setX(0)
-        self.__pieceOnSquare[k].setY(0)
-        self.__pieceOnSquare[k].stop('hovering')
-        self.__pieceOnSquare[k].play('landing')
+        self.__pieceOnSquare(k).reparentTo(self.__chessboard['squares'][k])
+        self.__pieceOnSquare(k).setX(0)
+        self.__pieceOnSquare(k).setY(0)
+        self.__pieceOnSquare(k).stop('hovering')
+        self.__pieceOnSquare(k).play('landing')
         self.__dragging = False
         if self.__marksAlwaysVisible:
             marks = self.__chessboard['marks']
             for i in self.__validMarks:
-                marks[i].hide()
+                marks.hide(i)
         return
 
     def onMouse1Released(self):
@@ -423,7 +420,7 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
                 if self.__marksAlwaysVisible:
                     marks = self.__chessboard['marks']
                     for i in self.__validMarks:
-                        marks[i].hide()
+                        marks.hide(i)
             return
 
         return
@@ -437,12 +434,11 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         self.__mouse3 = None
 
     def __isLegalMove(self, fr, to):
-        pid = self.__pidOnSquare[fr]
+        pid = self.__unitOnSquare[fr]
         if not pid:
             return False
-        valid_moves = self.arena.retrieve_valid_moves_of_unit(pid)
-        destination = gamearena.Square(x=to % 8, y=to // 8)
-        return destination in valid_moves
+        # 拿起棋子时已经查询过同一局面下的走法, 这里直接命中 arena 的走法缓存
+        return bool(self.arena.valid_moves_mask_of_unit(pid) >> to & 1)
 
     def __movePiece(self, fr, to):
 
@@ -451,26 +447,49 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         elif not self.__isLegalMove(fr, to):
             raise IllegalMoveException()
 
-        piece1 = self.__pieceOnSquare[fr]
-        piece2 = self.__pieceOnSquare[to]
-        self.__pieceOnSquare[to] = piece1
-        self.__pieceOnSquare[fr] = None  
-        pid1 = self.__pidOnSquare[fr]
-        pid2 = self.__pidOnSquare[to]  
-        piece1 = self.__pieces[pid1]
-        square2 = self.__chessboard['squares'][to]
-        piece1.reparentTo(square2)
-        piece1.setX(0)
-        piece1.setY(0)
-        piece1.stop('hovering')
-        piece1.play('landing')
-        self.__pidOnSquare[to] = pid1
-        self.__pidOnSquare[fr] = 0 
-        if pid2:
-            self.__sendToGraveyard(piece=piece2, gid=pid2)
-
+        pid1 = self.__unitOnSquare[fr]
         destination = gamearena.Square(x=to % 8, y=to // 8)
         self.arena.move_unit_to_somewhere(pid1, destination)
+        self.__applyArenaChanges()  # 走子和被吃掉的棋子都由 arena 的变化通知记录下来
+
+    def runSmokeTest(self, maxFrames=600, screenshot=None):
+        """冒烟测试: 等待棋子模型载入, 走 e4 d5 exd5 并渲染, 核对棋盘状态镜像、3D 模型与 arena 一致
+
+        供 main(['--smoke']) 在离屏窗口中使用, 返回进程退出码.
+        """
+        for frame in range(maxFrames):
+            self.taskMgr.step()
+            if self.__pieces:
+                break
+        else:
+            print('smoke: piece models not loaded after {} frames'.format(maxFrames), file=sys.stderr)
+            return 1
+        for fr, to in ((12, 28), (51, 35), (28, 35)):
+            self.__movePiece(fr, to)
+            self.taskMgr.step()
+        errors = []
+        expected = 'rnbqkbnr/ppp1pppp/8/3P4/8/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1'
+        if self.arena.to_fen() != expected:
+            errors.append('arena is {}, expected {}'.format(self.arena.to_fen(), expected))
+        squares = self.__chessboard['squares']
+        for i in range(64):
+            unit_id = self.arena.unit_id_at(i)
+            if self.__unitOnSquare[i] != unit_id:
+                errors.append('square {}: mirror has unit {}, arena has {}'.format(i, self.__unitOnSquare[i], unit_id))
+            elif unit_id and self.__pieces[unit_id].getPos(squares[i]).getXy().length() > 1E-3:
+                errors.append('square {}: piece model of unit {} is not on the square'.format(i, unit_id))
+        captured = [unit_id for unit_id, i in self.__squareOfUnit.items() if i is None]
+        if len(captured) != 1:
+            errors.append('expected one captured unit, got {}'.format(captured))
+        if screenshot:
+            self.screenshot(screenshot, defaultFilename=False)
+        for error in errors:
+            print('smoke: {}'.format(error), file=sys.stderr)
+        gsg = self.win.getGsg()
+        print('smoke: {} after {} frames, {} pieces, {} ({})'.format(
+            'FAILED' if errors else 'ok', frame + 1, len(self.__pieces),
+            'instanced' if self.__instancedPieces else 'per-piece', gsg.getDriverRenderer() if gsg else 'no renderer'))
+        return 1 if errors else 0
 
     def __sendToGraveyard(self, piece, gid):
         grave = self.__graveyard['graves'][gid]
@@ -499,45 +518,57 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         return {'graves': graves, 'graveyard': graveyard}
 
     def __selectChessPieceModelSytle(self, path='models/default'):
-        """查找载入路径 path 指定风格样式的棋子模型套件"""
-        # Models:
-        king = self.loader.loadModel("{}/king".format(path))
-        queen = self.loader.loadModel("{}/queen".format(path))
-        rook = self.loader.loadModel("{}/rook".format(path))
-        knight = self.loader.loadModel("{}/knight".format(path))
-        bishop = self.loader.loadModel("{}/bishop".format(path))
-        pawn = self.loader.loadModel("{}/pawn".format(path))
-        # Actors
-        king_actor = None
-        queen_actor = None
-        rook_actor = None
-        knight_actor = None
-        bishop_actor = None
-        pawn_actor = None
-        # # TODO: 为棋子添加动画效果
-        # # 可以用 self.__have_animations = True 或 False 进行设置
-        # if self.__have_animations:
-        #     import direct.actor.Actor
-        #     king_actor = direct.actor.Actor.Actor("{}/king".format(style), anims=None)
-        #     queen_actor = direct.actor.Actor.Actor("{}/queen".format(style), anims=None)
-        #     rook_actor = direct.actor.Actor.Actor("{}/rook".format(style), anims=None)
-        #     knight_actor = direct.actor.Actor.Actor("{}/knight".format(style), anims=None)
-        #     bishop_actor = direct.actor.Actor.Actor("{}/bishop".format(style), anims=None)
-        #     pawn_actor = direct.actor.Actor.Actor("{}/pawn".format(style), anims=None)
-        return {
-            'king': king,
-            'queen': queen,
-            'rook': rook,
-            'knight': knight,
-            'bishop': bishop,
-            'pawn': pawn,
-            'king_actor': king_actor,
-            'queen_actor': queen_actor,
-            'rook_actor': rook_actor,
-            'knight_actor': knight_actor,
-            'bishop_actor': bishop_actor,
-            'pawn_actor': pawn_actor,
+        """在后台载入路径 path 指定风格样式的棋子模型套件, 黑白双方共用同一套模型
+
+        第一次载入时把 .egg.pz 转换为 .bam 缓存(见 gamemodels), 以后的启动直接读取缓存.
+        """
+        loading = direct.gui.OnscreenText.OnscreenText(
+            text="Loading pieces...",
+            parent=self.a2dBottomLeft, align=panda3d.core.TextNode.ALeft,
+            style=1, fg=(1, 1, 1, 1), pos=(0.06, 0.1), scale=.05)
+
+        def progress(loaded, total, name):
+            loading.setText("Loading pieces... {}/{} ({})".format(loaded, total, name))
+
+        def done(models):
+            loading.destroy()
+            self.__onPieceModelsLoaded(models)
+
+        gamemodels.load_models_async(self.loader, path, done=done, progress=progress)
+        # # TODO: 为棋子添加动画效果(direct.actor.Actor)
+
+    def __onPieceModelsLoaded(self, models):
+        """按 self.__startingPieces 实例化全部棋子模型, 然后开始响应鼠标"""
+        colors = {
+            'WHITE': (1.000, 1.000, 1.000, 1),  # RGB color for WHITE pieces
+            'BLACK': (0.150, 0.150, 0.150, 1),  # RGB color for BLACK pieces
         }
+        squares = self.__chessboard['squares']
+        renderer = InstancedPieceRenderer(self.render, models) if self.__instancedPieces else None
+        for i, name, pid, color in self.__startingPieces:
+            # 实例化棋子的 3D 模型(初始定位到棋盘方格模型的上方)
+            piece_holder = squares[i].attachNewNode("pieceInstanceHolder")
+            piece_holder.setColor(colors[color])
+            if color == 'BLACK':
+                piece_holder.setH(180)  
+            if renderer:
+                # 挂载点本身不含几何体, 只提供变换、动画和碰撞盒, 由 renderer 按它的位置绘制
+                renderer.add(name, piece_holder, colors[color])
+            else:
+                models[name].instanceTo(piece_holder)
+            piece = CustomizedPiece(piece_holder, mask=panda3d.core.BitMask32.bit(1),
+                                    bounds=models[name].getTightBounds())
+            piece.setTag('piece', str(pid))
+            self.__pieces[pid] = piece
+        if renderer:
+            # 在动画(ivalLoop, sort=20)之后、渲染(igLoop, sort=50)之前更新实例数据
+            self.taskMgr.add(renderer.update, 'InstancedPiecesTask', sort=40)
+
+        self.taskMgr.add(self.mouseTask, 'MouseTask')
+        self.accept("mouse1", self.onMouse1Pressed)  
+        self.accept("mouse1-up", self.onMouse1Released) 
+        self.accept("mouse3", self.onMouse3Pressed)
+        self.accept("mouse3-up", self.onMouse3Released)
 
     @staticmethod
     def __squarePos(i):
@@ -577,13 +608,13 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         if self.__dragging:
             marks = self.__chessboard['marks']
             for i in self.__validMarks:
-                marks[i].show()
+                marks.show(i)
 
     def __makeMarksVisibleOnlyWhenSquareIsPointed(self):
         self.__marksAlwaysVisible = False
         marks = self.__chessboard['marks']
         for i in self.__validMarks:
-            marks[i].hide()
+            marks.hide(i)
 
     def toggleChessboardMarksBehavior(self, isChecked):
         if isChecked:
@@ -599,17 +630,193 @@ MarkColor = {
 }
 
 
-def mark_indexes_from_coordinates(coordinates):
-    result = []
-    for (x, y) in coordinates:
-        result.append(x + 8 * y)
-    return tuple(result)
+def makeSquaresGeomNode(name, colors, scales=None, z=0.0, usage=panda3d.core.Geom.UHStatic):
+    """生成 64 个方格组成的单个网格, colors[i] 和 scales[i] 为第 i 个方格的顶点颜色和边长
+
+    第 i 个方格占用顶点数据的第 4*i ~ 4*i+3 行, 之后可以用 GeomVertexRewriter 直接改写.
+    """
+    vdata = panda3d.core.GeomVertexData(name, panda3d.core.GeomVertexFormat.getV3n3c4(), usage)
+    vdata.setNumRows(64 * 4)
+    vertex = panda3d.core.GeomVertexWriter(vdata, 'vertex')
+    normal = panda3d.core.GeomVertexWriter(vdata, 'normal')
+    color = panda3d.core.GeomVertexWriter(vdata, 'color')
+    triangles = panda3d.core.GeomTriangles(panda3d.core.Geom.UHStatic)
+    for i in range(64):
+        for corner in squareCorners(i, 1.0 if scales is None else scales[i], z):
+            vertex.addData3(*corner)
+            normal.addData3(0, 0, 1)
+            color.addData4(*colors[i])
+        triangles.addVertices(4 * i, 4 * i + 1, 4 * i + 2)
+        triangles.addVertices(4 * i, 4 * i + 2, 4 * i + 3)
+    geom = panda3d.core.Geom(vdata)
+    geom.addPrimitive(triangles)
+    node = panda3d.core.GeomNode(name)
+    node.addGeom(geom)
+    return node
+
+
+def squareCorners(i, scale, z):
+    """第 i 个方格(中心与 MyChessboard.__squarePos(i) 相同)按逆时针顺序的 4 个角"""
+    cx = (i % 8) - 3.5
+    cy = (i // 8) - 3.5
+    h = 0.5 * scale
+    return (cx - h, cy - h, z), (cx + h, cy - h, z), (cx + h, cy + h, z), (cx - h, cy + h, z)
+
+
+class ChessboardMarks(object):
+    """64 个方格上的走法标记, 合并为一个网格
+
+    标记的颜色、大小和是否可见都通过改写该方格的 4 个顶点实现: 隐藏的标记顶点颜色的 alpha 为 0.
+    改变标记不会产生新的节点或渲染状态, 整个标记层始终只有一次绘制调用.
+    """
+
+    def __init__(self, parent, z=0.0, scale=0.75, color=None):
+        self.__z = z
+        self.__scales = [scale] * 64
+        self.__colors = [panda3d.core.LVecBase4f(color or MarkColor['UNACCEPTABLE_MOVE']) for i in range(64)]
+        self.__visible = [False] * 64
+        node = makeSquaresGeomNode('chessboardMarks', [self.__hidden(c) for c in self.__colors], self.__scales, z,
+                                   usage=panda3d.core.Geom.UHDynamic)
+        self.__vdata = node.modifyGeom(0).modifyVertexData()
+        self.__np = parent.attachNewNode(node)
+        self.__np.setTransparency(panda3d.core.TransparencyAttrib.MDual)
+
+    @staticmethod
+    def __hidden(color):
+        return panda3d.core.LVecBase4f(color[0], color[1], color[2], 0)
+
+    def __writeColor(self, i):
+        color = self.__colors[i] if self.__visible[i] else self.__hidden(self.__colors[i])
+        writer = panda3d.core.GeomVertexWriter(self.__vdata, 'color')
+        writer.setRow(4 * i)
+        for _ in range(4):
+            writer.setData4(color)
+
+    def setColor(self, i, color):
+        color = panda3d.core.LVecBase4f(color)
+        if color != self.__colors[i]:
+            self.__colors[i] = color
+            self.__writeColor(i)
+
+    def show(self, i):
+        if not self.__visible[i]:
+            self.__visible[i] = True
+            self.__writeColor(i)
+
+    def hide(self, i):
+        if self.__visible[i]:
+            self.__visible[i] = False
+            self.__writeColor(i)
+
+    def setScale(self, i, scale):
+        if scale == self.__scales[i]:
+            return
+        self.__scales[i] = scale
+        writer = panda3d.core.GeomVertexWriter(self.__vdata, 'vertex')
+        writer.setRow(4 * i)
+        for x, y, z in squareCorners(i, scale, self.__z):
+            writer.setData3(x, y, z)
+
+
+INSTANCED_PIECE_VERTEX_SHADER = """
+#version 140
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat3 p3d_NormalMatrix;
+uniform samplerBuffer instances;
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+out vec3 normal;
+out vec4 color;
+
+void main() {
+    // 每个实例在缓冲纹理中占 5 个像素: 变换矩阵的 4 行和颜色
+    int base = gl_InstanceID * 5;
+    mat4 transform = mat4(texelFetch(instances, base), texelFetch(instances, base + 1),
+                          texelFetch(instances, base + 2), texelFetch(instances, base + 3));
+    color = texelFetch(instances, base + 4);
+    normal = normalize(p3d_NormalMatrix * (mat3(transform) * p3d_Normal));
+    gl_Position = p3d_ModelViewProjectionMatrix * (transform * p3d_Vertex);
+}
+"""
+
+INSTANCED_PIECE_FRAGMENT_SHADER = """
+#version 140
+uniform struct { vec4 ambient; } p3d_LightModel;
+uniform struct { vec4 color; vec4 position; } p3d_LightSource[1];
+in vec3 normal;
+in vec4 color;
+out vec4 p3d_FragColor;
+
+void main() {
+    // 平行光的 position.w 为 0, xyz 为观察空间中指向光源的方向
+    vec3 light = p3d_LightSource[0].position.xyz;
+    float diffuse = dot(light, light) > 0.0 ? max(dot(normalize(normal), normalize(light)), 0.0) : 0.0;
+    p3d_FragColor = vec4(color.rgb * (p3d_LightModel.ambient.rgb + p3d_LightSource[0].color.rgb * diffuse), color.a);
+}
+"""
+
+# 在 Config.prc 中设置 "chess-instanced-pieces #t" 可以默认开启硬件实例化绘制
+INSTANCED_PIECES = panda3d.core.ConfigVariableBool('chess-instanced-pieces', False)
+
+
+class InstancedPieceRenderer(object):
+    """用硬件实例化绘制棋子: 每种棋子一个 GeomNode, 一次绘制调用画出这种棋子的全部实例
+
+    每个实例对应场景图中的一个挂载点(通常是 CustomizedPiece 的节点), 挂载点的位置、动画和碰撞盒都保持不变,
+    只是本身不含几何体. update() 每帧把全部挂载点的变换矩阵和颜色写入缓冲纹理, 顶点着色器按 gl_InstanceID 读取.
+    同一个 renderer 可以收纳多个棋盘的棋子, 同时显示很多局棋时绘制调用的次数仍然只等于棋子的种类数.
+    """
+    TEXELS_PER_INSTANCE = 5
+
+    def __init__(self, parent, models):
+        self.__root = parent.attachNewNode('instancedPieces')
+        self.__root.setShader(panda3d.core.Shader.make(
+            panda3d.core.Shader.SL_GLSL, INSTANCED_PIECE_VERTEX_SHADER, INSTANCED_PIECE_FRAGMENT_SHADER))
+        self.__types = {}  # 模型名称 -> [NodePath, 缓冲纹理, 容量, [(挂载点, 颜色), ...]]
+        for name, model in models.items():
+            np = model.copyTo(self.__root)
+            np.clearColor()
+            # 把模型内部的变换并入顶点, 着色器中的实例矩阵就直接作用于模型空间; 同时尽量合并为一个 Geom
+            np.flattenStrong()
+            # 节点的包围体只是一个模型的大小, 各个实例分布在整个棋盘上, 所以不做视锥裁剪
+            np.node().setBounds(panda3d.core.OmniBoundingVolume())
+            np.node().setFinal(True)
+            np.setInstanceCount(0)
+            self.__types[name] = [np, panda3d.core.Texture('instances-' + name), 0, []]
+
+    def add(self, name, holder, color):
+        """添加一个 name 类型的实例, 位置跟随节点 holder, 颜色为 color"""
+        entry = self.__types[name]
+        np, texture, capacity, instances = entry
+        instances.append((holder, tuple(color)))
+        if len(instances) > capacity:
+            entry[2] = capacity = max(16, 2 * capacity)
+            texture.setupBufferTexture(capacity * self.TEXELS_PER_INSTANCE, panda3d.core.Texture.T_float,
+                                       panda3d.core.Texture.F_rgba32, panda3d.core.GeomEnums.UH_dynamic)
+            np.setShaderInput('instances', texture)
+        np.setInstanceCount(len(instances))
+
+    def update(self, task=None):
+        for np, texture, capacity, instances in self.__types.values():
+            if not instances:
+                continue
+            data = array.array('f')
+            for holder, color in instances:
+                m = holder.getMat(np)
+                for row in range(4):
+                    v = m.getRow(row)
+                    data.extend((v[0], v[1], v[2], v[3]))
+                data.extend(color)
+            data.extend([0.0] * ((capacity - len(instances)) * self.TEXELS_PER_INSTANCE * 4))
+            texture.setRamImage(data.tobytes() if hasattr(data, 'tobytes') else data.tostring())  # Python 2 的 array 只有 tostring()
+        return direct.task.Task.cont
 
 
 class CustomizedPiece(object):
-    def __init__(self, node_path, mask):
+    def __init__(self, node_path, mask, bounds=None):
         self.__np = node_path
-        b = node_path.getTightBounds()
+        # 实例化绘制时 node_path 下没有几何体, 碰撞盒的大小由调用者按模型给出
+        b = bounds or node_path.getTightBounds()
         solid = panda3d.core.CollisionBox(b[0], b[1])
         self.__cb = panda3d.core.CollisionNode('pieceCollisionBox')
         self.__cb.addSolid(solid)
@@ -637,19 +844,6 @@ class CustomizedPiece(object):
             'landing': landing_interval,
         }
 
-        self.pickerRay = panda3d.core.CollisionRay()
-        self.pickerRay.setOrigin(0.0, 0.0, 0.0)
-        self.pickerRay.setDirection(0, 0, -1)
-        self.collisionNode = panda3d.core.CollisionNode('pieceCollisionNode')
-        self.collisionNode.setFromCollideMask(mask)  # 注意是碰撞源(From)
-        self.collisionNode.setIntoCollideMask(panda3d.core.BitMask32.allOff())
-        self.collisionNode.addSolid(self.pickerRay)
-        self.collisionNP = self.__np.attachNewNode(self.collisionNode)
-        self.collisionNP.setPos(0, 0, 0)
-        self.picker = panda3d.core.CollisionTraverser()
-        self.handler = panda3d.core.CollisionHandlerQueue()
-        self.picker.addCollider(self.collisionNP, self.handler)
-
     @staticmethod
     def _vertical_oscillating_motion(rad, piece, height):
         """垂直方向上震荡往复运动
@@ -707,6 +901,9 @@ class CustomizedPiece(object):
     def setPos(self, *args, **kwargs):
         self.__np.setPos(*args, **kwargs)
 
+    def getPos(self, *args, **kwargs):
+        return self.__np.getPos(*args, **kwargs)
+
     def setX(self, *args, **kwargs):
         self.__np.setX(*args, **kwargs)
 
@@ -729,18 +926,30 @@ class CustomizedPiece(object):
         self.__box.hide()
 
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gamegui', description='3D chessboard')
+    parser.add_argument('--instanced', action='store_true', help='draw pieces with hardware instancing')
+    parser.add_argument('--smoke', action='store_true',
+                        help='render offscreen, play a few moves, check the board state and exit')
+    parser.add_argument('--screenshot', help='with --smoke: save the final frame to this file')
+    args = parser.parse_args(argv)
+    if args.smoke:
+        panda3d.core.loadPrcFileData('smoke', 'audio-library-name null')  # 测试环境通常没有声卡
+
     ambientLight = panda3d.core.AmbientLight("ambientLight")
     ambientLight.setColor((.8, .8, .8, 1))
     directionalLight = panda3d.core.DirectionalLight("directionalLight")
     directionalLight.setDirection(panda3d.core.LVector3(0, 45, -45))
     directionalLight.setColor((0.2, 0.2, 0.2, 1))
 
-    base = MyChessboard()
+    base = MyChessboard(windowType='offscreen' if args.smoke else None, instancedPieces=args.instanced or None)
     base.render.setLight(base.render.attachNewNode(ambientLight)) 
     base.render.setLight(base.render.attachNewNode(directionalLight)) 
+    if args.smoke:
+        return base.runSmokeTest(screenshot=args.screenshot)
     base.run()
+    return 0
 
 
 if '__main__' == __name__:
-    main()
+    sys.exit(main())
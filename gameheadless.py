@@ -0,0 +1,328 @@
+# coding=utf-8
+"""不依赖 Panda3D 的命令行入口
+
+规则、走法生成和搜索都在纯 Python 的模块中, 这里的任何代码路径都不会导入 gamegui、panda3d、direct 或 Pmw.
+每个子命令只在被执行时才导入自己需要的模块, 以缩短按任务启动的工作进程的冷启动时间:
+
+    python -m gamearena perft [--position start --depth 4 ...]       # 同 gameperft
+    python -m gamearena analyze --fen "<FEN>" --depth 6               # 搜索一个局面, 给出最佳走法和主要变例
+    python -m gamearena analyze --epd tests.epd --time 1               # 逐行分析 EPD 文件, 有 bm 操作时核对答案
+    python -m gamearena serve                                          # 在标准输入输出上以 JSON 行协议对局
+    python -m gamearena serve --port 7000                              # 在 TCP 上托管多个会话(见 gameserver)
+    python -m gamearena importtime [--repeat 5]                        # 在全新的解释器中测量导入和启动耗时
+    python -m gamearena memory [--arenas 1000]                         # 每个 GameArena 占用的内存字节数
+
+serve 每行读入一个 JSON 请求, 每个请求输出一行 JSON 应答, 例如:
+
+    {"cmd": "new", "fen": "<FEN, 可省略>"}   ->  {"fen": "..."}
+    {"cmd": "move", "san": "e4"}             ->  {"fen": "...", "move": "e4"}
+    {"cmd": "moves"}                         ->  {"moves": ["a3", "a4", ...]}
+    {"cmd": "go", "depth": 6, "time": 1.0}   ->  {"best": "Nf3", "score": 25, "depth": 6, "pv": [...], "nodes": ...}
+    {"cmd": "fen"}                           ->  {"fen": "..."}
+    {"cmd": "quit"}                          ->  {"bye": true}
+
+出错时应答为 {"error": "..."}, 会话继续.
+"""
+from __future__ import print_function
+
+import numbers
+import sys
+
+# 导入后不应出现在 sys.modules 中的图形界面相关模块
+GUI_MODULES = ('panda3d', 'direct', 'Pmw', 'gamegui')
+
+# importtime 子命令测量的模块
+HEADLESS_MODULES = ('gamearena', 'gameengine', 'gamepgn', 'gameheadless')
+
+try:
+    _STRING_TYPES = basestring  # Python 2
+except NameError:
+    _STRING_TYPES = str
+
+
+def _typed_field(request, name, types, description, default=None):
+    """读取请求中可省略的字段 name, 类型不是 types 时抛出 ValueError(JSON 的 true/false 不算数字)"""
+    value = request.get(name, default)
+    if value is not None and (not isinstance(value, types) or isinstance(value, bool)):
+        raise ValueError('field "{}" must be {}, got {!r}'.format(name, description, value))
+    return value
+
+
+class Session(object):
+    """一局棋的会话: 一个 GameArena 加上一个复用置换表的 Engine, 按 JSON 请求字典操作"""
+
+    def __init__(self, arena=None):
+        import gameengine
+        if arena is None:
+            import gamearena
+            import gamepgn
+            arena = gamearena.GameArena.from_fen(gamepgn.START_FEN)
+        self.arena = arena
+        self.engine = gameengine.Engine(arena)
+
+    def new(self, fen=None):
+        import gamearena
+        import gamepgn
+        self.arena = self.engine.arena = gamearena.GameArena.from_fen(fen or gamepgn.START_FEN)
+        self.engine.table.clear()
+
+    def handle(self, request):
+        """处理一个请求字典, 返回应答字典. 请求无效时返回 {"error": ...}, 会话状态保持不变"""
+        import gamepgn
+        try:
+            command = request['cmd']
+        except (KeyError, TypeError):
+            return {'error': 'request needs a "cmd" field'}
+        try:
+            if command == 'new':
+                self.new(_typed_field(request, 'fen', _STRING_TYPES, 'a FEN string'))
+                return {'fen': self.arena.to_fen()}
+            if command == 'fen':
+                return {'fen': self.arena.to_fen()}
+            if command == 'moves':
+                return {'moves': [gamepgn.move_to_san(self.arena, move) for move in self.arena.generate_moves()]}
+            if command == 'move':
+                san = request['san']
+                if not isinstance(san, _STRING_TYPES):
+                    raise ValueError('field "san" must be a string, got {!r}'.format(san))
+                unit_id, target = gamepgn.resolve_san(self.arena, san)
+                self.arena.move_unit_to_somewhere(unit_id, target)
+                return {'fen': self.arena.to_fen(), 'move': san}
+            if command == 'go':
+                return self.go(_typed_field(request, 'depth', numbers.Integral, 'an integer', 64),
+                               _typed_field(request, 'time', numbers.Real, 'a number of seconds'),
+                               _typed_field(request, 'nodes', numbers.Integral, 'an integer'))
+            if command == 'quit':
+                return {'bye': True}
+        except KeyError as e:
+            return {'error': 'missing field {}'.format(e)}
+        except ValueError as e:  # 包括 IllegalMoveError 和无效的 FEN
+            return {'error': str(e)}
+        return {'error': 'unknown command {!r}'.format(command)}
+
+    def go(self, depth=64, time_limit=None, node_limit=None):
+        """搜索当前局面, 最佳走法和主要变例以 SAN 给出. 没有任何预算时默认搜索 1 秒"""
+        if time_limit is None and node_limit is None and depth >= 64:
+            time_limit = 1.0
+        result = self.engine.search(depth, time_limit, node_limit)
+        return dict(self.describe(result), fen=self.arena.to_fen())
+
+    def describe(self, result):
+        """把 SearchResult 转换为可以序列化为 JSON 的字典"""
+        import gamepgn
+        arena = self.arena
+        pv = []
+        for move in result.pv:
+            pv.append(gamepgn.move_to_san(arena, move))
+            arena.make_move(move)
+        for _ in result.pv:
+            arena.unmake_move()
+        return {
+            'best': gamepgn.move_to_san(arena, result.best_move) if result.best_move is not None else None,
+            'score': result.score,
+            'depth': result.depth,
+            'pv': pv,
+            'nodes': result.nodes,
+            'seconds': round(result.seconds, 3),
+        }
+
+
+def serve(argv):
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(prog='python -m gamearena serve',
+                                     description='play one game over JSON lines on standard input/output')
+    parser.add_argument('--fen', help='initial position (default: the standard start position)')
+    parser.add_argument('--port', type=int, default=None,
+                        help='host many sessions over TCP instead (see gameserver)')
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args(argv)
+    if args.port is not None:
+        import gameserver
+        gameserver.serve(args.host, args.port)
+        return 0
+    session = Session()
+    if args.fen:
+        session.new(args.fen)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'error': 'invalid JSON: {}'.format(e)}
+        else:
+            response = session.handle(request)
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+        if 'bye' in response:
+            break
+    return 0
+
+
+def analyze(argv):
+    import argparse
+    import gamearena
+    import gameperft
+    parser = argparse.ArgumentParser(prog='python -m gamearena analyze',
+                                     description='search positions and print the best move and principal variation')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--fen', help='position in FEN')
+    group.add_argument('--position', choices=sorted(gameperft.POSITIONS), help='one of the built-in positions')
+    group.add_argument('--epd', help='EPD file, one position per line; "bm" operations are checked')
+    parser.add_argument('--depth', type=int, default=64)
+    parser.add_argument('--time', type=float, default=None, help='seconds per position')
+    parser.add_argument('--nodes', type=int, default=None, help='node budget per position')
+    args = parser.parse_args(argv)
+    if args.depth >= 64 and args.time is None and args.nodes is None:
+        args.time = 1.0
+
+    if args.epd:
+        with open(args.epd) as f:
+            positions = [gamearena.GameArena.from_epd(line) for line in f if line.strip()]
+    else:
+        fen = args.fen or gameperft.POSITIONS[args.position or 'start'][0]
+        positions = [(gamearena.GameArena.from_fen(fen), {})]
+    failed = 0
+    for number, (arena, operations) in enumerate(positions, 1):
+        session = Session(arena)
+        info = session.describe(session.engine.search(args.depth, args.time, args.nodes))
+        expected = operations.get('bm')
+        note = ''
+        if expected:
+            note = '  ok' if info['best'] in expected else '  expected {}'.format(' '.join(expected))
+            failed += info['best'] not in expected
+        label = ' '.join(operations.get('id', [])) or str(number)
+        print('{}: best {} score {} depth {} nodes {} {:.3f}s pv {}{}'.format(
+            label, info['best'], info['score'], info['depth'], info['nodes'], info['seconds'],
+            ' '.join(info['pv']), note))
+    return 1 if failed else 0
+
+
+def perft(argv):
+    import gameperft
+    return gameperft.main(argv)
+
+
+def importtime(argv):
+    """在全新的解释器中分别导入每个模块, 报告导入耗时, 并确认没有导入任何图形界面模块"""
+    import argparse
+    import os
+    import subprocess
+    import time
+    parser = argparse.ArgumentParser(prog='python -m gamearena importtime',
+                                     description='measure cold import and start-up time in fresh interpreters')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per measurement (best is kept)')
+    args = parser.parse_args(argv)
+    here = os.path.dirname(os.path.abspath(__file__))
+    probe = ('from __future__ import print_function\n'
+             'import sys, time\n'
+             'started = time.time()\n'
+             'import {module}\n'
+             'seconds = time.time() - started\n'
+             'gui = [m for m in sys.modules if m.split(".")[0] in {gui!r}]\n'
+             'print(seconds, ",".join(gui))\n')
+    leaked = False
+    print('{:28s} {:>10s} {:>12s}'.format('module', 'import', 'process'))
+    for module in HEADLESS_MODULES:
+        best_import = best_process = None
+        gui = ''
+        for _ in range(args.repeat):
+            started = time.time()
+            output = subprocess.check_output([sys.executable, '-c', probe.format(module=module, gui=GUI_MODULES)],
+                                             cwd=here, universal_newlines=True)
+            process = time.time() - started
+            seconds, _, gui = output.strip().partition(' ')
+            best_import = min(best_import or float(seconds), float(seconds))
+            best_process = min(best_process or process, process)
+        leaked = leaked or bool(gui)
+        print('{:28s} {:9.1f}ms {:11.1f}ms{}'.format(module, best_import * 1000, best_process * 1000,
+                                                     '  imports GUI modules: ' + gui if gui else ''))
+    for command in (['-c', 'pass'], ['-m', 'gamearena', 'perft', '--position', 'start', '--depth', '1']):
+        best_process = None
+        for _ in range(args.repeat):
+            started = time.time()
+            subprocess.check_output([sys.executable] + command, cwd=here)
+            process = time.time() - started
+            best_process = min(best_process or process, process)
+        print('{:28s} {:>10s} {:11.1f}ms'.format('python ' + ' '.join(command[:3]), '', best_process * 1000))
+    return 1 if leaked else 0
+
+
+def _memory_meter():
+    """返回 (读取当前内存用量的函数, 计量方式的说明), 两者都无法使用时返回 (None, None)
+
+    tracemalloc 只有 Python 3 才有; Python 2 退而使用 resource 给出的进程峰值常驻内存, 精度只有若干 KB,
+    所以要用较多的 arena 才能得到有意义的平均值. Windows 上的 Python 2 两者都没有.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        try:
+            import resource
+        except ImportError:
+            return None, None
+        scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss 在 macOS 上以字节为单位, 在 Linux 上以 KB 为单位
+        return (lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale), 'peak RSS'
+    tracemalloc.start()
+    return (lambda: tracemalloc.get_traced_memory()[0]), 'tracemalloc'
+
+
+def memory(argv):
+    """建立许多个相同的 GameArena, 统计平均每个 arena、其中每个单位以及每个 fork() 副本占用的字节数"""
+    import argparse
+    import gamearena
+    import gameperft
+    parser = argparse.ArgumentParser(prog='python -m gamearena memory',
+                                     description='report the memory taken by one GameArena')
+    parser.add_argument('--arenas', type=int, default=1000)
+    parser.add_argument('--position', choices=sorted(gameperft.POSITIONS), default='start')
+    args = parser.parse_args(argv)
+    fen = gameperft.POSITIONS[args.position][0]
+    gamearena.GameArena.from_fen(fen).generate_moves()  # 先建好各种共享的缓存(攻击表等), 不计入结果
+    used_bytes, method = _memory_meter()
+    if used_bytes is None:
+        print('memory: needs tracemalloc (Python 3) or the resource module', file=sys.stderr)
+        return 1
+    before = used_bytes()
+    arenas = [gamearena.GameArena.from_fen(fen) for _ in range(args.arenas)]
+    for arena in arenas:
+        arena.generate_moves()  # 包括快照在内的稳定状态
+    used = used_bytes() - before
+    units = bin(arenas[0].occupancy_mask()).count('1')
+    print('{}: {} arenas, {:.0f} bytes per arena, {:.0f} bytes per unit ({})'.format(
+        args.position, args.arenas, used / float(args.arenas), used / float(args.arenas * units), method))
+    parent = arenas[0]
+    move = parent.generate_moves()[0]
+    before = used_bytes()
+    forks = [parent.fork() for _ in range(args.arenas)]
+    for child in forks:
+        child.generate_moves()
+    forked = used_bytes() - before
+    for child in forks:
+        child.make_move(move)
+    moved = used_bytes() - before
+    print('{}: {:.0f} bytes per fork, {:.0f} bytes per fork after one move ({})'.format(
+        args.position, forked / float(args.arenas), moved / float(args.arenas), method))
+    return 0
+
+
+COMMANDS = {
+    'serve': serve,
+    'analyze': analyze,
+    'perft': perft,
+    'importtime': importtime,
+    'memory': memory,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print('usage: python -m gamearena {{{}}} [options]'.format('|'.join(sorted(COMMANDS))), file=sys.stderr)
+        return 2
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if '__main__' == __name__:
+    sys.exit(main())
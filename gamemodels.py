@@ -0,0 +1,186 @@
+# coding=utf-8
+"""棋子模型的载入管线
+
+models/<风格>/ 下的 .egg / .egg.pz 是文本格式, 每次载入都要解压和解析. 这里第一次载入某个模型时把它另存为
+Panda3D 的二进制格式 .bam, 放在 models/cache/<Panda3D 版本>/<风格>/ 下, 之后直接读取 .bam;
+源文件比缓存新时重新转换. 黑白双方共用同一套模型, 颜色和朝向由各自的实例节点设置.
+
+    models = gamemodels.load_models('models/default', progress=print)       # 同步载入, 返回 {名称: NodePath}
+    gamemodels.load_models_async(base.loader, 'models/default', done, progress)  # 异步载入, 全部完成后调用 done(models)
+
+progress(已载入个数, 总个数, 模型名称) 在每个模型载入完成后调用一次.
+
+冷启动(没有缓存)和热启动(已有缓存)的载入耗时基准, 每次都在全新的解释器中测量:
+
+    python -m gamemodels bench [--style models/default] [--repeat 3]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PIECE_NAMES = ('king', 'queen', 'rook', 'knight', 'bishop', 'pawn')
+DEFAULT_STYLE = 'models/default'
+CACHE_ROOT = os.path.join(ROOT, 'models', 'cache')
+SOURCE_EXTENSIONS = ('.egg.pz', '.egg', '.bam')
+
+
+def source_path(style, name):
+    """模型 name 的源文件, 依次查找 SOURCE_EXTENSIONS 中的扩展名"""
+    for extension in SOURCE_EXTENSIONS:
+        path = os.path.join(ROOT, style, name + extension)
+        if os.path.exists(path):
+            return path
+    raise IOError('no model {!r} in {}'.format(name, os.path.join(ROOT, style)))
+
+
+def cached_path(style, name, cache_root=CACHE_ROOT):
+    """模型 name 的 .bam 缓存. .bam 文件与 Panda3D 的版本相关, 所以按版本分目录"""
+    import panda3d.core
+    version = panda3d.core.PandaSystem.getVersionString()
+    return os.path.join(cache_root, version, os.path.normpath(style).replace(os.sep, '_'), name + '.bam')
+
+
+def _is_fresh(source, cached):
+    return os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(source)
+
+
+def _plan(style, names, cache_root):
+    """[(名称, 要载入的文件, 载入后需要写出的缓存或 None), ...]"""
+    plan = []
+    for name in names:
+        source = source_path(style, name)
+        cached = cached_path(style, name, cache_root)
+        if source.endswith('.bam'):
+            plan.append((name, source, None))
+        elif _is_fresh(source, cached):
+            plan.append((name, cached, None))
+        else:
+            plan.append((name, source, cached))
+    return plan
+
+
+def _write_cache(model, cached):
+    """把刚从源文件载入的模型写成 .bam. 先写临时文件再改名, 并发启动的多个进程不会读到写了一半的缓存"""
+    import panda3d.core
+    directory = os.path.dirname(cached)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = '{}.{}.tmp'.format(cached, os.getpid())
+    if not model.writeBamFile(panda3d.core.Filename.fromOsSpecific(temporary)):
+        return False
+    if hasattr(os, 'replace'):
+        os.replace(temporary, cached)
+    else:
+        # Python 2 没有 os.replace, 而 Windows 上 os.rename 不能覆盖已有的文件
+        if os.path.exists(cached):
+            os.remove(cached)
+        os.rename(temporary, cached)
+    return True
+
+
+def load_models(style=DEFAULT_STYLE, names=PIECE_NAMES, progress=None, cache_root=CACHE_ROOT):
+    """同步载入一套棋子模型, 返回 {名称: NodePath}"""
+    import panda3d.core
+    loader = panda3d.core.Loader.getGlobalPtr()
+    options = panda3d.core.LoaderOptions(panda3d.core.LoaderOptions.LF_no_cache)  # 由这里管理缓存
+    plan = _plan(style, names, cache_root)
+    models = {}
+    for name, path, cached in plan:
+        node = loader.loadSync(panda3d.core.Filename.fromOsSpecific(path), options)
+        if node is None:
+            raise IOError('cannot load model {}'.format(path))
+        model = panda3d.core.NodePath(node)
+        if cached:
+            _write_cache(model, cached)
+        models[name] = model
+        if progress:
+            progress(len(models), len(plan), name)
+    return models
+
+
+def load_models_async(loader, style=DEFAULT_STYLE, done=None, progress=None, names=PIECE_NAMES,
+                      cache_root=CACHE_ROOT):
+    """用 ShowBase 的 loader 在后台线程中载入一套棋子模型, 全部载入后在主线程中调用 done({名称: NodePath})"""
+    import panda3d.core
+    plan = _plan(style, names, cache_root)
+    models = {}
+
+    def loaded(model, name, cached):
+        if model is None:
+            raise IOError('cannot load model {}'.format(dict((n, p) for n, p, c in plan)[name]))
+        if cached:
+            _write_cache(model, cached)
+        models[name] = model
+        if progress:
+            progress(len(models), len(plan), name)
+        if len(models) == len(plan) and done:
+            done(models)
+
+    for name, path, cached in plan:
+        loader.loadModel(panda3d.core.Filename.fromOsSpecific(path), noCache=True, callback=loaded,
+                         extraArgs=[name, cached])
+
+
+def _load(style, cache_root):
+    """bench 在子进程中执行: 导入 Panda3D 并同步载入一套模型, 输出耗时(秒)"""
+    started = time.time()
+    load_models(style, cache_root=cache_root)
+    print('{:.6f}'.format(time.time() - started))
+
+
+def _measure(style, cache_root):
+    output = subprocess.check_output([sys.executable, '-m', 'gamemodels', 'load', '--style', style,
+                                      '--cache', cache_root], cwd=ROOT)
+    return float(output.decode('ascii').split()[-1])
+
+
+def bench(style=DEFAULT_STYLE, repeat=3, out=sys.stdout):
+    """冷启动每次使用一个空的缓存目录, 热启动使用冷启动写出的缓存. 返回 (冷启动最短耗时, 热启动最短耗时)"""
+    cold, warm = [], []
+    for _ in range(repeat):
+        cache_root = tempfile.mkdtemp()
+        try:
+            cold.append(_measure(style, cache_root))
+            warm.append(_measure(style, cache_root))
+        finally:
+            shutil.rmtree(cache_root)
+    out.write('{} ({} models, best of {})\n'.format(style, len(PIECE_NAMES), repeat))
+    out.write('  cold (parse .egg.pz, write .bam) {:8.1f} ms\n'.format(min(cold) * 1000))
+    out.write('  warm (read .bam)                 {:8.1f} ms\n'.format(min(warm) * 1000))
+    out.write('  speedup                          {:8.1f}x\n'.format(min(cold) / min(warm) if min(warm) else 0.0))
+    return min(cold), min(warm)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m gamemodels', description='model cache and loading benchmark')
+    commands = parser.add_subparsers(dest='command')
+    bench_parser = commands.add_parser('bench', help='measure cold and warm model loading in fresh interpreters')
+    bench_parser.add_argument('--style', default=DEFAULT_STYLE)
+    bench_parser.add_argument('--repeat', type=int, default=3)
+    convert_parser = commands.add_parser('convert', help='convert every model of a style to the .bam cache')
+    convert_parser.add_argument('--style', default=DEFAULT_STYLE)
+    load_parser = commands.add_parser('load', help='load every model of a style once and print the seconds taken')
+    load_parser.add_argument('--style', default=DEFAULT_STYLE)
+    load_parser.add_argument('--cache', default=CACHE_ROOT)
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        bench(args.style, args.repeat)
+    elif args.command == 'convert':
+        load_models(args.style, progress=lambda loaded, total, name: print('{}/{} {}'.format(loaded, total, name)))
+    elif args.command == 'load':
+        _load(args.style, args.cache)
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# coding=utf-8
+"""多进程并行搜索(Lazy SMP)
+
+纯 Python 的搜索受 GIL 限制只能用到一个 CPU 核心. ParallelSearch 在进程池中让每个工作进程各自持有一份 GameArena,
+同时从根节点开始搜索同一个局面, 并通过共享内存中的置换表(SharedTranspositionTable)互相利用对方的结果.
+0 号进程按正常顺序搜索, 其余进程把根节点走法轮换后再搜索, 以便尽早探索不同的分支. 0 号进程完成后通知其他进程停止,
+最终结果取完成深度最大的那个进程的结果.
+
+    with gameparallel.ParallelSearch(workers=8) as searcher:
+        result = searcher.search(arena, max_depth=8, time_limit=2.0)
+
+扩展性基准: 对 1..N 个工作进程分别报告搜索到指定深度所需的时间和每秒节点数:
+
+    python -m gameparallel --workers 8 --depth 5
+"""
+from __future__ import print_function
+
+import argparse
+import ctypes
+import multiprocessing
+import sys
+import time
+
+import gamearena
+import gameengine
+
+# 置换表每条记录的数据打包成一个 64 位整数: 走法(32 位) | 分值(22 位, 加偏移量) | 深度(8 位) | 分值性质(2 位)
+_VALUE_OFFSET = 1 << 21
+_VALUE_MASK = (1 << 22) - 1
+
+
+def _pack_entry(depth, value, move, bound):
+    return move & 0xFFFFFFFF | (value + _VALUE_OFFSET) << 32 | min(depth, 255) << 54 | bound << 62
+
+
+def _unpack_entry(data):
+    return data >> 54 & 0xFF, (data >> 32 & _VALUE_MASK) - _VALUE_OFFSET, data & 0xFFFFFFFF, data >> 62
+
+
+class SharedTranspositionTable(object):
+    """存放在共享内存中的置换表, 接口与 gamearena.TranspositionTable 相同
+
+    多个进程并发读写时不加锁: 每个槽位保存 (键值 ^ 数据, 数据) 两个 64 位整数, 读到被并发写坏的槽位时键值对不上,
+    只会当作未命中处理. 分值必须是绝对值小于 2**21 的整数. 命中率等计数器只统计本进程的访问.
+    """
+
+    EXACT = gamearena.TranspositionTable.EXACT
+    LOWER_BOUND = gamearena.TranspositionTable.LOWER_BOUND
+    UPPER_BOUND = gamearena.TranspositionTable.UPPER_BOUND
+
+    def __init__(self, entries=1 << 16, depth_preferred=True, buffers=None):
+        if entries < 2 or entries & (entries - 1):
+            raise ValueError('entries must be a power of two: {}'.format(entries))
+        self.depth_preferred = depth_preferred
+        self.__bucket_mask = (entries >> 1) - 1 if depth_preferred else entries - 1
+        if buffers is None:
+            buffers = (multiprocessing.RawArray(ctypes.c_uint64, entries),
+                       multiprocessing.RawArray(ctypes.c_uint64, entries))
+        self.buffers = buffers  # 创建进程池时传给工作进程, 让它们访问同一块共享内存
+        self.__checks, self.__data = buffers
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def __len__(self):
+        return len(self.__data)
+
+    def clear(self):
+        ctypes.memset(self.__checks, 0, ctypes.sizeof(self.__checks))
+        ctypes.memset(self.__data, 0, ctypes.sizeof(self.__data))
+        self.hits = self.misses = self.stores = self.replacements = 0
+
+    def __slots_of(self, key):
+        bucket = key & self.__bucket_mask
+        if self.depth_preferred:
+            return bucket << 1, bucket << 1 | 1
+        return bucket, bucket
+
+    def probe(self, key):
+        for slot in self.__slots_of(key):
+            data = self.__data[slot]
+            if data and self.__checks[slot] ^ data == key:
+                self.hits += 1
+                return _unpack_entry(data)
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, value, move=0, bound=EXACT):
+        deep, always = self.__slots_of(key)
+        checks, datas = self.__checks, self.__data
+        deep_data = datas[deep]
+        if not deep_data or checks[deep] ^ deep_data == key or depth >= deep_data >> 54 & 0xFF:
+            slot = deep
+        else:
+            slot = always
+        old = datas[slot]
+        if old and checks[slot] ^ old != key:
+            self.replacements += 1
+        data = _pack_entry(depth, value, move, bound)
+        datas[slot] = data
+        checks[slot] = key ^ data
+        self.stores += 1
+
+    @property
+    def hit_rate(self):
+        probes = self.hits + self.misses
+        return self.hits / float(probes) if probes else 0.0
+
+
+# 以下全局变量只在工作进程中使用, 由 _init_worker() 在进程启动时设置
+_worker_table = None
+_worker_stop = None
+
+
+def _init_worker(entries, buffers, stop_flag):
+    global _worker_table, _worker_stop
+    _worker_table = SharedTranspositionTable(entries, buffers=buffers)
+    _worker_stop = stop_flag
+
+
+def _worker_search(arena, worker_index, max_depth, time_limit, node_limit):
+    """在工作进程中搜索 arena(已经序列化后传入, 是本进程独有的副本)"""
+    moves = list(arena.generate_moves())
+    if worker_index and moves:
+        shift = worker_index % len(moves)
+        moves = moves[shift:] + moves[:shift]
+    engine = gameengine.Engine(arena, table=_worker_table)
+    result = engine.search(max_depth, time_limit, node_limit, root_moves=moves, stop=lambda: _worker_stop.value)
+    return worker_index, result
+
+
+class ParallelSearch(object):
+    def __init__(self, workers=None, table_entries=1 << 18):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.table = SharedTranspositionTable(table_entries)
+        self.__stop = multiprocessing.RawValue(ctypes.c_bool, False)
+        self.__pool = multiprocessing.Pool(self.workers, _init_worker,
+                                           (table_entries, self.table.buffers, self.__stop))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.__pool.terminate()
+        self.__pool.join()
+
+    def search(self, arena, max_depth=64, time_limit=None, node_limit=None):
+        """返回 SearchResult, 其中 nodes 是所有工作进程的节点数之和, seconds 是实际经过的时间
+
+        node_limit 对每个工作进程分别生效. arena 本身不会被修改.
+        """
+        started = time.time()
+        self.__stop.value = False
+        pending = [self.__pool.apply_async(_worker_search, (arena, i, max_depth, time_limit, node_limit))
+                   for i in range(self.workers)]
+        main_result = pending[0].get()[1]
+        self.__stop.value = True
+        best = main_result
+        nodes = 0
+        for job in pending:
+            worker_index, result = job.get()
+            nodes += result.nodes
+            if result.depth > best.depth:
+                best = result
+        return best._replace(nodes=nodes, seconds=time.time() - started)
+
+
+def run_scaling_benchmark(arena, max_workers, depth, out=sys.stdout):
+    """对 1..max_workers 个工作进程分别搜索到 depth 层, 报告耗时和每秒节点数, 返回 [(进程数, SearchResult), ...]"""
+    results = []
+    baseline = None
+    for workers in range(1, max_workers + 1):
+        with ParallelSearch(workers) as searcher:
+            result = searcher.search(arena, max_depth=depth)
+        baseline = baseline or result.seconds
+        out.write('workers {:3d}  time-to-depth {:8.3f}s  speedup {:5.2f}  {:>9d} nodes  {:>9.0f} nodes/s  depth {}\n'
+                  .format(workers, result.seconds, baseline / result.seconds if result.seconds else 0.0,
+                          result.nodes, result.nodes / result.seconds if result.seconds else 0.0, result.depth))
+        results.append((workers, result))
+    return results
+
+
+def main(argv=None):
+    import gameperft
+    parser = argparse.ArgumentParser(prog='python -m gameparallel',
+                                     description='scaling benchmark for the multi-process search')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='largest number of worker processes to measure')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--position', choices=sorted(gameperft.POSITIONS), default='start')
+    args = parser.parse_args(argv)
+    arena = gamearena.GameArena.from_fen(gameperft.POSITIONS[args.position][0])
+    run_scaling_benchmark(arena, args.workers, args.depth)
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# coding=utf-8
+"""走法生成器的 perft 测试与性能基准
+
+perft 从给定局面出发, 双方轮流按 GameArena.generate_moves() 走遍所有走法, 统计第 depth 层叶子节点的个数.
+节点数与记录在 POSITIONS 中的参考值不符时说明走法生成器的行为发生了变化.
+
+用法:
+    python -m gamearena perft                          # 逐一测试 POSITIONS 中的全部局面
+    python -m gamearena perft --position start --depth 4 --divide
+    python -m gamearena perft --fen "8/8/8/3k4/8/8/8/R3K3 w - - 0 1" --depth 3
+
+注意这里的规则与标准国际象棋不同(没有王车易位和吃过路兵, 除国王本身以外不检查走子后是否被将军,
+兵到达底线自动升变为后), 所以参考值也与标准国际象棋的 perft 数值不同.
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+import gamearena
+
+# 局面名 -> (FEN, {深度: 参考节点数})
+POSITIONS = {
+    'start': (
+        'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+        {1: 20, 2: 400, 3: 8902, 4: 197702},
+    ),
+    'open-files': (
+        'r3k2r/pp3ppp/8/8/8/8/PP3PPP/R3K2R w KQkq - 0 1',
+        {1: 19, 2: 359, 3: 7359, 4: 149622},
+    ),
+    'promotion': (
+        'n3k3/1P6/8/8/8/8/6p1/4K2N w - - 0 1',
+        {1: 8, 2: 68, 3: 935, 4: 12105},
+    ),
+    'king-walk': (
+        '8/8/3k4/8/8/4K3/8/R6r b - - 0 1',
+        {1: 22, 2: 427, 3: 8311, 4: 154663},
+    ),
+}
+
+
+class PerftMismatchError(Exception):
+    pass
+
+
+def perft(arena, depth):
+    """从当前局面出发走 depth 层, 返回叶子节点数. 结束时局面保持不变"""
+    if depth <= 0:
+        return 1
+    moves = arena.generate_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        arena.make_move(move)
+        nodes += perft(arena, depth - 1)
+        arena.unmake_move()
+    return nodes
+
+
+def divide(arena, depth):
+    """返回 [(根节点走法, 该走法之下的叶子节点数), ...]"""
+    result = []
+    for move in arena.generate_moves():
+        arena.make_move(move)
+        result.append((move, perft(arena, depth - 1)))
+        arena.unmake_move()
+    return result
+
+
+def move_name(arena, move):
+    """坐标记法, 例如 e2e4"""
+    from_index, to_index, flags = gamearena.unpack_move(move)
+    return square_name(arena.square_from_index(from_index)) + square_name(arena.square_from_index(to_index))
+
+
+def square_name(square):
+    return '{}{}'.format(chr(ord('a') + square.x), square.y + 1)
+
+
+def run(fen, depth, reference=None, show_divide=False, out=sys.stdout):
+    """逐层统计 1..depth 的节点数和速度, 与参考值不符时抛出 PerftMismatchError"""
+    arena = gamearena.GameArena.from_fen(fen)
+    total_nodes, total_seconds = 0, 0.0
+    for d in range(1, depth + 1):
+        started = time.time()
+        nodes = perft(arena, d)
+        seconds = time.time() - started
+        total_nodes += nodes
+        total_seconds += seconds
+        expected = (reference or {}).get(d)
+        note = '' if expected is None else ' ok' if expected == nodes else ' MISMATCH (expected {})'.format(expected)
+        out.write('  depth {:2d} {:>12d} nodes {:8.3f}s {:>10.0f} nodes/s{}\n'.format(
+            d, nodes, seconds, nodes / seconds if seconds else 0.0, note))
+        if expected is not None and expected != nodes:
+            raise PerftMismatchError('{}: depth {} gives {} nodes, expected {}'.format(fen, d, nodes, expected))
+    if show_divide:
+        for move, nodes in sorted(divide(arena, depth), key=lambda item: move_name(arena, item[0])):
+            out.write('  {} {}\n'.format(move_name(arena, move), nodes))
+    return total_nodes, total_seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m gamearena perft',
+                                     description='count move-generator leaf nodes and report nodes/second')
+    parser.add_argument('--depth', type=int, default=None,
+                        help='search depth (default: every depth with a recorded reference)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--fen', help='position in FEN, e.g. "8/8/8/3k4/8/8/8/R3K3 w - - 0 1"')
+    group.add_argument('--position', choices=sorted(POSITIONS), help='one of the built-in positions')
+    parser.add_argument('--divide', action='store_true', help='print the node count below every root move')
+    args = parser.parse_args(argv)
+
+    if args.fen:
+        suite = [('fen', args.fen, {})]
+    else:
+        names = [args.position] if args.position else sorted(POSITIONS)
+        suite = [(name,) + POSITIONS[name] for name in names]
+    total_nodes, total_seconds = 0, 0.0
+    try:
+        for name, fen, reference in suite:
+            depth = args.depth or max(reference or {1: None})
+            print('{} ({})'.format(name, fen))
+            nodes, seconds = run(fen, depth, reference, args.divide)
+            total_nodes += nodes
+            total_seconds += seconds
+    except PerftMismatchError as e:
+        print('perft: {}'.format(e), file=sys.stderr)
+        return 1
+    print('total {} nodes in {:.3f}s, {:.0f} nodes/s'.format(
+        total_nodes, total_seconds, total_nodes / total_seconds if total_seconds else 0.0))
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
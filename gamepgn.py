@@ -0,0 +1,324 @@
+# coding=utf-8
+"""流式读取 PGN 棋谱并按 gamearena 的规则逐局复盘
+
+整个文件按行读取, tokenize() 是一个生成器, 逐个给出记号; read_games() 把记号组合成一局一局的 PgnGame,
+每次只在内存中保留当前这一局, 所以无论文件有多大, 内存占用都保持不变. replay() 把一局棋的 SAN 走法
+依次交给 GameArena 执行, 遇到不合规则的走法时抛出 IllegalMoveError; validate() 对每一局给出一个 GameReport.
+
+    with open('games.pgn') as f:
+        for report in gamepgn.validate(f):
+            if report.error:
+                print(report.number, report.error)
+
+命令行用法(报告每秒复盘的局数):
+
+    python -m gamepgn games.pgn [more.pgn ...] [--errors]
+
+注意这里的规则与标准国际象棋不同: 没有王车易位和吃过路兵, 兵到达底线只能升变为后.
+含有这些走法的棋局会被报告为不合规则. 棋子被牵制时标准 SAN 可以省略消歧义的起点,
+因此有多个候选棋子时优先选择走完之后己方国王不被将军的那一个.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import re
+import sys
+import time
+
+import gamearena
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+# 记号类型
+TAG = 'tag'  # 值为 (名称, 内容)
+MOVE = 'move'  # 值为 SAN 字符串, 已去掉 !? 等注释符号
+RESULT = 'result'  # 值为 RESULTS 之一
+
+PgnGame = collections.namedtuple('PgnGame', ['headers', 'moves', 'result'])
+GameReport = collections.namedtuple('GameReport', ['number', 'headers', 'result', 'plies', 'error'])
+
+_TOKEN_PATTERN = re.compile(r'''
+    \s+
+  | \[\s*(?P<tag>\w+)\s+"(?P<value>(?:[^"\\]|\\.)*)"\s*\]
+  | (?P<result>1-0|0-1|1/2-1/2|\*)
+  | \d+\s*\.+
+  | \$\d+
+  | (?P<open>[{(])
+  | (?P<close>\))
+  | ;.*
+  | (?P<move>[^\s{}()\[\];$]+)
+''', re.VERBOSE)
+
+_SAN_PATTERN = re.compile(r'^(?P<piece>[NBRQK])?(?P<file>[a-wyz])?(?P<rank>\d+)?x?(?P<to>[a-z]\d+)'
+                          r'(?:=?(?P<promotion>[NBRQ]))?[+#]*$')
+
+
+class IllegalMoveError(ValueError):
+    def __init__(self, message, ply=None):
+        super(IllegalMoveError, self).__init__(message)
+        self.ply = ply  # 出错的半回合序号(从 1 开始), 由 replay() 填写
+
+
+def tokenize(lines):
+    """逐行读取 PGN 文本, 依次生成 (记号类型, 值). 注释、变着、NAG 和着法编号被跳过
+
+    花括号注释可以跨行; 以 % 开头的行是转义行, 整行忽略.
+    """
+    comment = False  # 是否处在跨行的 {} 注释中
+    variations = 0  # 当前 () 变着的嵌套层数
+    for line in lines:
+        if line.startswith('%'):
+            continue
+        position = 0
+        if comment:
+            end = line.find('}')
+            if end < 0:
+                continue
+            comment = False
+            position = end + 1
+        length = len(line)
+        while position < length:
+            match = _TOKEN_PATTERN.match(line, position)
+            if match is None:
+                position += 1  # 跳过无法识别的字符
+                continue
+            position = match.end()
+            if match.group('open') == '{':
+                end = line.find('}', position)
+                if end < 0:
+                    comment = True
+                    break
+                position = end + 1
+            elif match.group('open') == '(':
+                variations += 1
+            elif match.group('close'):
+                variations = max(variations - 1, 0)
+            elif variations:
+                continue
+            elif match.group('tag'):
+                yield TAG, (match.group('tag'), match.group('value').replace('\\"', '"').replace('\\\\', '\\'))
+            elif match.group('result'):
+                yield RESULT, match.group('result')
+            elif match.group('move'):
+                yield MOVE, match.group('move').rstrip('!?')
+
+
+def read_games(lines):
+    """逐局生成 PgnGame(有序的标签字典, SAN 走法列表, 结果). 文件末尾缺少结果的棋局结果记为 '*'"""
+    headers = collections.OrderedDict()
+    moves = []
+    for kind, value in tokenize(lines):
+        if kind == TAG:
+            if moves:  # 上一局缺少结果记号
+                yield PgnGame(headers, moves, '*')
+                headers, moves = collections.OrderedDict(), []
+            headers[value[0]] = value[1]
+        elif kind == MOVE:
+            moves.append(value)
+        else:
+            yield PgnGame(headers, moves, value)
+            headers, moves = collections.OrderedDict(), []
+    if headers or moves:
+        yield PgnGame(headers, moves, '*')
+
+
+def start_position(headers):
+    """按 FEN 标签(如果有)建立开局局面, 否则使用标准开局"""
+    return gamearena.GameArena.from_fen(headers.get('FEN') or START_FEN)
+
+
+def resolve_san(arena, san):
+    """把当前走棋方的一个 SAN 走法解析为 (单位编码, 目标格子), 无法解析或不合规则时抛出 IllegalMoveError"""
+    if san.rstrip('+#') in ('O-O', 'O-O-O', '0-0', '0-0-0'):
+        raise IllegalMoveError('{}: castling is not part of the rules'.format(san))
+    match = _SAN_PATTERN.match(san)
+    if match is None:
+        raise IllegalMoveError('{}: not a SAN move'.format(san))
+    player_id = arena.side_to_move
+    white = player_id == gamearena.FEN_PLAYERS[0]
+    letter = match.group('piece') or 'P'
+    unit_type = gamearena.FEN_PIECES[letter if white else letter.lower()][1]
+    if match.group('promotion') not in (None, 'Q'):
+        raise IllegalMoveError('{}: pawns can only be promoted to queens'.format(san))
+    try:
+        target = _parse_square(match.group('to'))
+        arena.square_index(target)
+    except ValueError:
+        raise IllegalMoveError('{}: square {} is off the board'.format(san, match.group('to')))
+    from_file = match.group('file')
+    from_rank = match.group('rank')
+    promoted = unit_type is gamearena.QueenUnit  # 升变后的兵按后的方式走, 在 SAN 中也记为 Q
+    mask = arena.unit_type_mask(unit_type)
+    if promoted:
+        mask |= arena.unit_type_mask(gamearena.WhitePawnUnit) | arena.unit_type_mask(gamearena.BlackPawnUnit)
+    candidates = []
+    for index in gamearena.iterate_bits(mask & arena.occupancy_mask(player_id)):
+        square = arena.square_from_index(index)
+        if from_file is not None and square.x != ord(from_file) - ord('a'):
+            continue
+        if from_rank is not None and square.y != int(from_rank) - 1:
+            continue
+        unit_id = arena.unit_id_at(index)
+        unit = arena.unit_info(unit_id)
+        if isinstance(unit, gamearena.AbstractPawnUnit) and unit.has_been_queen != promoted:
+            continue
+        if target in arena.retrieve_valid_moves_of_unit(unit_id):
+            candidates.append(unit_id)
+    if not candidates:
+        raise IllegalMoveError('{}: no {} can move to {}'.format(san, unit_type.__name__, match.group('to')))
+    if len(candidates) > 1:
+        candidates = [unit_id for unit_id in candidates if not _exposes_king(arena, unit_id, target)]
+        if len(candidates) != 1:
+            raise IllegalMoveError('{}: ambiguous move'.format(san))
+    return candidates[0], target
+
+
+def _parse_square(name):
+    return gamearena.Square(ord(name[0]) - ord('a'), int(name[1:]) - 1)
+
+
+def _exposes_king(arena, unit_id, target):
+    """试走一步, 看走完之后己方国王是否被将军"""
+    player_id = arena.owner_of_unit(unit_id)
+    from_index = arena.square_index(arena.find_square_from_unit_id(unit_id))
+    arena.make_move(gamearena.pack_move(from_index, arena.square_index(target)))
+    try:
+        return arena.is_in_check(player_id)
+    finally:
+        arena.unmake_move()
+
+
+def move_to_san(arena, move):
+    """把 generate_moves() 给出的走法写成 SAN(不加 + 和 # 后缀), 需要在走这一步之前调用"""
+    from_index, to_index, flags = gamearena.unpack_move(move)
+    unit_id = arena.unit_id_at(from_index)
+    unit = arena.unit_info(unit_id)
+    from_square = arena.square_from_index(from_index)
+    target = arena.square_from_index(to_index)
+    capture = 'x' if flags & gamearena.MOVE_FLAG_CAPTURE else ''
+    if isinstance(unit, gamearena.AbstractPawnUnit) and not unit.has_been_queen:
+        origin = _file_name(from_square.x) if capture else ''
+        promotion = '=Q' if flags & gamearena.MOVE_FLAG_PROMOTION else ''
+        return origin + capture + _square_name(target) + promotion
+    if isinstance(unit, gamearena.AbstractPawnUnit):
+        letter = 'Q'
+    else:
+        letter = gamearena.FEN_LETTERS[type(unit)]
+    # 同一方、在 SAN 中记为同一字母、也能走到目标格子的其他单位, 需要用起点的列或行区分
+    rivals = []
+    for index in gamearena.iterate_bits(arena.occupancy_mask(unit.owner)):
+        other_id = arena.unit_id_at(index)
+        if other_id == unit_id:
+            continue
+        other = arena.unit_info(other_id)
+        if isinstance(other, gamearena.AbstractPawnUnit):
+            other_letter = 'Q' if other.has_been_queen else None
+        else:
+            other_letter = gamearena.FEN_LETTERS[type(other)]
+        if other_letter == letter and target in arena.retrieve_valid_moves_of_unit(other_id):
+            rivals.append(arena.square_from_index(index))
+    origin = ''
+    if rivals:
+        if all(square.x != from_square.x for square in rivals):
+            origin = _file_name(from_square.x)
+        elif all(square.y != from_square.y for square in rivals):
+            origin = str(from_square.y + 1)
+        else:
+            origin = _square_name(from_square)
+    return letter + origin + capture + _square_name(target)
+
+
+def _file_name(x):
+    return chr(ord('a') + x)
+
+
+def _square_name(square):
+    return '{}{}'.format(_file_name(square.x), square.y + 1)
+
+
+def format_game(headers, sans, result='*'):
+    """把标签和 SAN 走法列表排版为一局 PGN 文本(以空行结尾)"""
+    lines = ['[{} "{}"]'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in headers.items()]
+    lines.append('')
+    words = []
+    for ply, san in enumerate(sans):
+        if ply % 2 == 0:
+            words.append('{}.'.format(ply // 2 + 1))
+        words.append(san)
+    words.append(result)
+    line = ''
+    for word in words:
+        if line and len(line) + 1 + len(word) > 79:
+            lines.append(line)
+            line = word
+        else:
+            line = '{} {}'.format(line, word) if line else word
+    lines.append(line)
+    return '\n'.join(lines) + '\n\n'
+
+
+def replay(game, arena=None):
+    """在 arena(默认按标签建立开局局面)上依次执行 game 的全部走法, 返回 arena
+
+    第 n 步(从 1 开始计数的半回合)不合规则时抛出 IllegalMoveError, 异常信息中包含步数.
+    """
+    if arena is None:
+        arena = start_position(game.headers)
+    for ply, san in enumerate(game.moves, 1):
+        try:
+            unit_id, target = resolve_san(arena, san)
+        except IllegalMoveError as e:
+            raise IllegalMoveError('ply {}: {}'.format(ply, e), ply)
+        arena.move_unit_to_somewhere(unit_id, target)
+    return arena
+
+
+def validate(lines):
+    """逐局复盘, 为每一局生成一个 GameReport(局号从 1 开始, 标签, 结果, 成功执行的半回合数, 错误信息或 None)"""
+    for number, game in enumerate(read_games(lines), 1):
+        try:
+            replay(game)
+        except IllegalMoveError as e:
+            yield GameReport(number, game.headers, game.result, e.ply - 1, str(e))
+        except ValueError as e:  # FEN 标签无效
+            yield GameReport(number, game.headers, game.result, 0, 'FEN: {}'.format(e))
+        else:
+            yield GameReport(number, game.headers, game.result, len(game.moves), None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m gamepgn',
+                                     description='replay PGN archives against the gamearena rules and report games/second')
+    parser.add_argument('files', nargs='+', help='PGN files ("-" reads standard input)')
+    parser.add_argument('--errors', action='store_true', help='print every game that contains an illegal move')
+    args = parser.parse_args(argv)
+
+    games = illegal = plies = 0
+    started = time.time()
+    for name in args.files:
+        f = sys.stdin if name == '-' else open(name)
+        try:
+            for report in validate(f):
+                games += 1
+                plies += report.plies
+                if report.error:
+                    illegal += 1
+                    if args.errors:
+                        print('{} game {} ({} - {}): {}'.format(
+                            name, report.number, report.headers.get('White', '?'), report.headers.get('Black', '?'),
+                            report.error))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    seconds = time.time() - started
+    print('{} games ({} with illegal moves), {} plies in {:.3f}s, {:.1f} games/s, {:.0f} plies/s'.format(
+        games, illegal, plies, seconds, games / seconds if seconds else 0.0, plies / seconds if seconds else 0.0))
+    return 1 if illegal else 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,299 @@
+# coding=utf-8
+"""紧凑的二进制棋局记录文件, 用 mmap 按局号随机读取
+
+文件格式(所有整数均为小端序):
+
+    文件头   magic 'GREC' | 版本号(uint16) | 保留(uint16) | 索引偏移(uint64) | 棋局数(uint64)
+    棋局     标签长度(uint16) | 走法数(uint32) | 标签 | 走法...
+    索引     每局一个 uint64, 为该局记录在文件中的偏移
+
+标签是 UTF-8 编码的 "名称\\0内容\\0" 序列, 与 PGN 一样用 FEN 标签记录非标准的开局局面.
+每个走法固定占 2 字节: 起点下标(7 位) | 终点下标(7 位) | 标志位(2 位, 即 MOVE_FLAG_CAPTURE 和 MOVE_FLAG_PROMOTION),
+所以棋盘最多 128 个格子. 索引放在文件末尾. 重新打开文件追加棋局时, 新的棋局写在旧索引之后, 关闭时再把新的索引
+写在文件末尾并最后改写文件头; 关闭之前进程意外退出, 文件头仍然指向旧索引, 已有的棋局不会丢失
+(代价是每次追加都会在文件中留下一份不再使用的旧索引, 每局 8 字节).
+
+    with gamerecord.GameRecordWriter('games.grec') as writer:
+        writer.append(moves, {'White': 'A', 'Black': 'B', 'Result': '1-0'})   # moves 为 generate_moves() 给出的走法
+
+    with gamerecord.GameRecordReader('games.grec') as reader:
+        arena = reader.replay(123456)   # 只读取第 123456 局用到的字节
+
+与 PGN 比较读取速度的基准:
+
+    python -m gamerecord --games 2000 --plies 80
+"""
+from __future__ import print_function
+
+import argparse
+import array
+import collections
+import io
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+import gamearena
+import gamepgn
+
+MAGIC = b'GREC'
+VERSION = 1
+
+_FILE_HEADER = struct.Struct('<4sHHQQ')
+_GAME_HEADER = struct.Struct('<HI')
+_OFFSET = struct.Struct('<Q')
+
+_SQUARE_BITS = 7
+_SQUARE_MASK = (1 << _SQUARE_BITS) - 1
+MAX_SQUARES = 1 << _SQUARE_BITS
+
+
+class GameRecordError(ValueError):
+    pass
+
+
+def encode_move(move):
+    """把 pack_move() 的编码压缩为 16 位整数"""
+    from_index, to_index, flags = gamearena.unpack_move(move)
+    if from_index >= MAX_SQUARES or to_index >= MAX_SQUARES:
+        raise GameRecordError('board too large for game records: square index {}'.format(max(from_index, to_index)))
+    return from_index | to_index << _SQUARE_BITS | (flags & 3) << 2 * _SQUARE_BITS
+
+
+def decode_move(code):
+    return gamearena.pack_move(code & _SQUARE_MASK, code >> _SQUARE_BITS & _SQUARE_MASK, code >> 2 * _SQUARE_BITS)
+
+
+def _encode_headers(headers):
+    data = b''.join(name.encode('utf-8') + b'\0' + value.encode('utf-8') + b'\0'
+                    for name, value in (headers or {}).items())
+    if len(data) > 0xFFFF:
+        raise GameRecordError('headers too long: {} bytes'.format(len(data)))
+    return data
+
+
+def _decode_headers(data):
+    fields = data.decode('utf-8').split('\0')[:-1]
+    return collections.OrderedDict(zip(fields[0::2], fields[1::2]))
+
+
+def _to_bytes(codes):
+    return codes.tobytes() if hasattr(codes, 'tobytes') else codes.tostring()  # Python 2 的 array 只有 tostring()
+
+
+def _from_bytes(typecode, data):
+    codes = array.array(typecode)
+    if hasattr(codes, 'frombytes'):
+        codes.frombytes(data)
+    else:
+        codes.fromstring(data)
+    return codes
+
+
+def _little_endian(codes):
+    if sys.byteorder != 'little':
+        codes.byteswap()
+    return codes
+
+
+class GameRecordWriter(object):
+    """向记录文件追加棋局. 文件不存在时新建, 已存在时保留原有的棋局"""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            self.__file = open(path, 'r+b')
+            magic, version, _, index_offset, count = _read_file_header(self.__file, path)
+            self.__file.seek(index_offset)
+            index = self.__file.read(count * _OFFSET.size)
+            self.__offsets = [_OFFSET.unpack_from(index, i * _OFFSET.size)[0] for i in range(count)]
+            self.__file.seek(0, os.SEEK_END)  # 旧索引在 close() 改写文件头之前一直有效
+        else:
+            self.__file = open(path, 'w+b')
+            self.__offsets = []
+            self.__file.write(_FILE_HEADER.pack(MAGIC, VERSION, 0, _FILE_HEADER.size, 0))
+        self.__committed = len(self.__offsets)  # 文件头中记录的棋局数
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.__offsets)
+
+    def append(self, moves, headers=None):
+        """追加一局棋, moves 为 pack_move() 编码的走法序列(例如依次交给 make_move() 的走法), 返回局号"""
+        codes = _little_endian(array.array('H', [encode_move(move) for move in moves]))
+        data = _encode_headers(headers)
+        f = self.__file
+        self.__offsets.append(f.tell())
+        f.write(_GAME_HEADER.pack(len(data), len(codes)))
+        f.write(data)
+        f.write(_to_bytes(codes))
+        return len(self.__offsets) - 1
+
+    def close(self):
+        """在文件末尾写出索引, 确认写入磁盘后再改写文件头. 关闭之前追加的棋局对读取者不可见"""
+        f = self.__file
+        if f.closed:
+            return
+        if len(self.__offsets) != self.__committed or f.tell() == _FILE_HEADER.size:
+            index_offset = f.tell()
+            f.write(b''.join(_OFFSET.pack(offset) for offset in self.__offsets))
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(0)
+            f.write(_FILE_HEADER.pack(MAGIC, VERSION, 0, index_offset, len(self.__offsets)))
+            self.__committed = len(self.__offsets)
+        f.close()
+
+
+def _read_file_header(f, path):
+    data = f.read(_FILE_HEADER.size)
+    if len(data) < _FILE_HEADER.size:
+        raise GameRecordError('{}: truncated game record file'.format(path))
+    header = _FILE_HEADER.unpack(data)
+    if header[0] != MAGIC:
+        raise GameRecordError('{}: not a game record file'.format(path))
+    if header[1] != VERSION:
+        raise GameRecordError('{}: unsupported version {}'.format(path, header[1]))
+    return header
+
+
+class GameRecordReader(object):
+    """用 mmap 打开记录文件, 按局号读取标签、走法或直接复盘, 不会读入其他棋局的数据"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, _, self.__index_offset, self.__count = _read_file_header(f, path)
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.__map.close()
+
+    def __len__(self):
+        return self.__count
+
+    def __locate(self, number):
+        if not 0 <= number < self.__count:
+            raise IndexError('game {} out of range (0..{})'.format(number, self.__count - 1))
+        offset = _OFFSET.unpack_from(self.__map, self.__index_offset + number * _OFFSET.size)[0]
+        headers_length, move_count = _GAME_HEADER.unpack_from(self.__map, offset)
+        return offset + _GAME_HEADER.size, headers_length, move_count
+
+    def headers(self, number):
+        start, headers_length, move_count = self.__locate(number)
+        return _decode_headers(self.__map[start:start + headers_length])
+
+    def moves(self, number):
+        """返回第 number 局的全部走法, 为 pack_move() 编码的 array('L')"""
+        start, headers_length, move_count = self.__locate(number)
+        start += headers_length
+        codes = _from_bytes('H', self.__map[start:start + 2 * move_count])
+        return array.array('L', [decode_move(code) for code in _little_endian(codes)])
+
+    def replay(self, number):
+        """按 FEN 标签(如果有)建立开局局面, 依次 make_move() 第 number 局的全部走法, 返回 GameArena
+
+        记录中的走法来自 generate_moves(), 这里不再检查是否合规, 复盘之后仍可用 unmake_move() 逐步倒退.
+        """
+        arena = gamepgn.start_position(self.headers(number))
+        for move in self.moves(number):
+            arena.make_move(move)
+        return arena
+
+
+def random_game(rng, max_plies):
+    """从标准开局出发随机走棋, 直到走满 max_plies 步、无子可走或一方失去国王. 返回 (SAN 列表, 走法列表)"""
+    arena = gamepgn.start_position({})
+    sans, moves = [], []
+    for _ in range(max_plies):
+        candidates = arena.generate_moves()
+        if not candidates:
+            break
+        move = rng.choice(candidates)
+        sans.append(gamepgn.move_to_san(arena, move))
+        moves.append(move)
+        arena.make_move(move)
+        if not arena.unit_type_mask(gamearena.KingUnit) & arena.occupancy_mask(arena.side_to_move):
+            break
+    return sans, moves
+
+
+def run_benchmark(games, plies, seed=1, out=sys.stdout):
+    """生成 games 局随机棋局, 分别存为 PGN 和记录文件, 比较文件大小、解析速度、复盘速度和随机读取单局的耗时"""
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp()
+    pgn_path = os.path.join(directory, 'games.pgn')
+    record_path = os.path.join(directory, 'games.grec')
+    try:
+        with io.open(pgn_path, 'w', encoding='utf-8') as pgn, GameRecordWriter(record_path) as writer:
+            for number in range(games):
+                sans, moves = random_game(rng, plies)
+                headers = collections.OrderedDict([('Event', 'benchmark'), ('Round', str(number + 1)),
+                                                   ('Result', '*')])
+                pgn.write(u'' + gamepgn.format_game(headers, sans))  # Python 2 的 io.open 只接受 unicode
+                writer.append(moves, headers)
+        out.write('{} games: PGN {} bytes, game records {} bytes\n'.format(
+            games, os.path.getsize(pgn_path), os.path.getsize(record_path)))
+
+        def report(name, seconds):
+            out.write('  {:32s} {:8.3f}s {:10.1f} games/s\n'.format(name, seconds, games / seconds if seconds else 0.0))
+
+        started = time.time()
+        with io.open(pgn_path, encoding='utf-8') as f:
+            for game in gamepgn.read_games(f):
+                pass
+        report('PGN parse', time.time() - started)
+        started = time.time()
+        with GameRecordReader(record_path) as reader:
+            for number in range(len(reader)):
+                reader.headers(number)
+                reader.moves(number)
+        report('game records decode', time.time() - started)
+        started = time.time()
+        with io.open(pgn_path, encoding='utf-8') as f:
+            for game in gamepgn.read_games(f):
+                gamepgn.replay(game)
+        report('PGN parse + replay', time.time() - started)
+        started = time.time()
+        with GameRecordReader(record_path) as reader:
+            for number in range(len(reader)):
+                reader.replay(number)
+            report('game records decode + replay', time.time() - started)
+            started = time.time()
+            reader.replay(games - 1)
+            out.write('  {:32s} {:8.3f}s\n'.format('game records replay last game', time.time() - started))
+    finally:
+        for path in (pgn_path, record_path):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m gamerecord',
+                                     description='compare loading binary game records against PGN')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--plies', type=int, default=80, help='maximum plies per random game')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    run_benchmark(args.games, args.plies, args.seed)
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
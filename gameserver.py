@@ -0,0 +1,336 @@
+# coding=utf-8
+"""用 asyncio 在一个进程中托管大量对局会话的 TCP 服务器
+
+协议为逐行的 JSON: 客户端每行发送一个请求, 服务器每个请求回复一行应答, 请求中的 "id" 字段(如有)原样放入应答,
+同一连接上最多同时处理 max_inflight 个请求, 应答的顺序不一定与请求的顺序相同. 会话由服务器托管, 与连接无关:
+
+    {"cmd": "create", "fen": "<FEN, 可省略>"}   ->  {"session": "1", "fen": "..."}
+    {"cmd": "subscribe", "session": "1"}       ->  {"subscribed": "1"}, 之后该会话每走一步都会收到
+                                                    {"event": "move", "session": "1", "move": "e4", "fen": "..."}
+    {"cmd": "unsubscribe", "session": "1"}     ->  {"unsubscribed": "1"}
+    {"cmd": "close", "session": "1"}           ->  {"closed": "1"}
+    {"cmd": "stats"}                           ->  {"sessions": ..., "connections": ...}
+
+其余命令(new, fen, moves, move, go)与 gameheadless.Session 相同, 需要带上 "session" 字段.
+每个会话有一把 asyncio.Lock, 同一会话的请求依次执行; 搜索(go)放到线程池中执行, 不阻塞事件循环.
+
+背压: 每个连接的待发送消息放在有界队列中, 由单独的任务写出并等待 drain(). 客户端不读取应答时队列会被填满,
+服务器随之停止读取该连接的请求. 订阅者的队列已满时不会等待它, 而是断开这个过慢的连接.
+
+    python -m gameserver serve --port 7000
+    python -m gameserver bench --clients 64 --duration 10      # 负载测试, 报告延迟的 p50/p99 和每核心会话数
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import gameheadless
+
+MAX_LINE = 1 << 16  # 请求行的最大长度(字节)
+
+
+class HostedSession(object):
+    def __init__(self, session_id, session):
+        self.id = session_id
+        self.session = session
+        self.lock = asyncio.Lock()
+        self.subscribers = set()  # 订阅了该会话的 Connection
+
+
+class Connection(object):
+    """一个客户端连接: 有界的发送队列 + 负责写出的任务"""
+
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.queue = asyncio.Queue(queue_size)
+        self.subscriptions = set()  # 订阅的会话编码
+        self.closed = False
+
+    async def send(self, message):
+        """发送应答, 队列已满时等待(向读取请求的一方传递背压)"""
+        await self.queue.put(message)
+
+    def notify(self, message):
+        """发送订阅事件, 不等待. 队列已满时返回 False"""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def pump(self):
+        writer = self.writer
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                break
+            writer.write(json.dumps(message).encode('utf-8') + b'\n')
+            await writer.drain()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class GameServer(object):
+    def __init__(self, max_sessions=100000, max_inflight=32, queue_size=256):
+        self.max_sessions = max_sessions
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self.sessions = {}  # 会话编码 -> HostedSession
+        self.connections = set()
+        self.__session_ids = itertools.count(1)
+
+    async def start(self, host='127.0.0.1', port=7000):
+        return await asyncio.start_server(self.handle_connection, host, port, limit=MAX_LINE)
+
+    async def handle_connection(self, reader, writer):
+        connection = Connection(writer, self.queue_size)
+        self.connections.add(connection)
+        pump = asyncio.ensure_future(connection.pump())
+        inflight = asyncio.Semaphore(self.max_inflight)
+        tasks = set()
+        try:
+            while not connection.closed:
+                await inflight.acquire()
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    await connection.send({'error': 'request longer than {} bytes'.format(MAX_LINE)})
+                    break
+                except ConnectionError:
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    inflight.release()
+                    continue
+                task = asyncio.ensure_future(self.__serve_request(connection, line, inflight))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+            await connection.queue.put(None)
+            await pump
+        except ConnectionError:
+            pass
+        finally:
+            pump.cancel()
+            for session_id in connection.subscriptions:
+                hosted = self.sessions.get(session_id)
+                if hosted is not None:
+                    hosted.subscribers.discard(connection)
+            self.connections.discard(connection)
+            connection.close()
+
+    async def __serve_request(self, connection, line, inflight):
+        try:
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                response = {'error': 'invalid JSON: {}'.format(e)}
+            else:
+                try:
+                    response = await self.handle(connection, request)
+                except Exception as e:  # 任何请求都必须有应答, 否则客户端会一直等待这个 id
+                    response = {'error': '{}: {}'.format(type(e).__name__, e)}
+                if isinstance(request, dict) and 'id' in request:
+                    response['id'] = request['id']
+            await connection.send(response)
+        finally:
+            inflight.release()
+
+    async def handle(self, connection, request):
+        """处理一个请求字典, 返回应答字典"""
+        if not isinstance(request, dict):
+            return {'error': 'request must be a JSON object'}
+        command = request.get('cmd')
+        if not isinstance(command, str):
+            return {'error': 'request needs a string "cmd" field'}
+        if command == 'create':
+            fen = request.get('fen')
+            if fen is not None and not isinstance(fen, str):
+                return {'error': 'field "fen" must be a FEN string, got {!r}'.format(fen)}
+            return self.create(fen)
+        if command == 'stats':
+            return {'sessions': len(self.sessions), 'connections': len(self.connections)}
+        hosted = self.sessions.get(str(request.get('session')))
+        if hosted is None:
+            return {'error': 'no such session {!r}'.format(request.get('session'))}
+        if command == 'subscribe':
+            hosted.subscribers.add(connection)
+            connection.subscriptions.add(hosted.id)
+            return {'subscribed': hosted.id}
+        if command == 'unsubscribe':
+            hosted.subscribers.discard(connection)
+            connection.subscriptions.discard(hosted.id)
+            return {'unsubscribed': hosted.id}
+        async with hosted.lock:
+            if command == 'close':
+                del self.sessions[hosted.id]
+                self.__publish(hosted, {'event': 'close', 'session': hosted.id})
+                for subscriber in hosted.subscribers:
+                    subscriber.subscriptions.discard(hosted.id)
+                return {'closed': hosted.id}
+            if command == 'go':
+                loop = asyncio.get_event_loop()
+                response = await loop.run_in_executor(None, hosted.session.handle, request)
+            else:
+                response = hosted.session.handle(request)
+            if 'error' not in response and command in ('move', 'new'):
+                self.__publish(hosted, dict(response, event=command, session=hosted.id))
+            return response
+
+    def create(self, fen=None):
+        if len(self.sessions) >= self.max_sessions:
+            return {'error': 'too many sessions ({})'.format(self.max_sessions)}
+        session = gameheadless.Session()
+        if fen:
+            try:
+                session.new(fen)
+            except ValueError as e:
+                return {'error': str(e)}
+        session_id = str(next(self.__session_ids))
+        self.sessions[session_id] = HostedSession(session_id, session)
+        return {'session': session_id, 'fen': session.arena.to_fen()}
+
+    def __publish(self, hosted, event):
+        for subscriber in list(hosted.subscribers):
+            if not subscriber.notify(event):  # 订阅者读得太慢, 断开连接而不是无限制地缓存事件
+                hosted.subscribers.discard(subscriber)
+                subscriber.close()
+
+
+def serve(host='127.0.0.1', port=7000, max_sessions=100000):
+    async def run():
+        server = await GameServer(max_sessions).start(host, port)
+        print('serving on {}'.format(', '.join('{}:{}'.format(*s.getsockname()[:2]) for s in server.sockets)))
+        sys.stdout.flush()
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def _load_client(host, port, deadline, plies, rng, latencies, counters):
+    """一个模拟客户端: 不断新建会话, 随机走棋 plies 步后关闭, 直到 deadline"""
+    reader, writer = await asyncio.open_connection(host, port, limit=MAX_LINE)
+
+    async def call(request):
+        started = time.time()
+        writer.write(json.dumps(request).encode('utf-8') + b'\n')
+        await writer.drain()
+        response = json.loads((await reader.readline()).decode('utf-8'))
+        latencies.append(time.time() - started)
+        return response
+
+    try:
+        while time.time() < deadline:
+            session_id = (await call({'cmd': 'create'}))['session']
+            counters['sessions'] += 1
+            for _ in range(plies):
+                moves = (await call({'cmd': 'moves', 'session': session_id}))['moves']
+                if not moves or time.time() >= deadline:
+                    break
+                await call({'cmd': 'move', 'session': session_id, 'san': rng.choice(moves)})
+            await call({'cmd': 'close', 'session': session_id})
+    finally:
+        writer.close()
+
+
+def run_load(host, port, clients, duration, plies=40, seed=1, out=sys.stdout):
+    """clients 个并发客户端持续 duration 秒, 报告请求数、吞吐量、延迟的 p50/p99 和每个 CPU 核心承载的会话数"""
+    latencies = []
+    counters = {'sessions': 0}
+    rng = random.Random(seed)
+
+    async def run():
+        deadline = time.time() + duration
+        await asyncio.gather(*[_load_client(host, port, deadline, plies, random.Random(rng.random()),
+                                            latencies, counters) for _ in range(clients)])
+
+    started = time.time()
+    asyncio.run(run())
+    seconds = time.time() - started
+    latencies.sort()
+    cores = os.cpu_count() or 1
+    out.write('{} clients, {} requests in {:.2f}s, {:.0f} requests/s, {} sessions played\n'.format(
+        clients, len(latencies), seconds, len(latencies) / seconds, counters['sessions']))
+    out.write('latency p50 {:.2f}ms  p99 {:.2f}ms  max {:.2f}ms\n'.format(
+        _percentile(latencies, 0.5) * 1000, _percentile(latencies, 0.99) * 1000,
+        (latencies[-1] if latencies else 0.0) * 1000))
+    out.write('{} CPU cores: {:.1f} concurrent sessions/core, {:.0f} requests/s/core\n'.format(
+        cores, clients / float(cores), len(latencies) / seconds / cores))
+    return latencies
+
+
+def _free_port():
+    s = socket.socket()
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def bench(host, port, clients, duration, plies):
+    """没有指定 port 时在子进程中启动一个服务器再测量, 以免客户端和服务器争用同一个解释器"""
+    server = None
+    if port is None:
+        port = _free_port()
+        server = subprocess.Popen([sys.executable, '-m', 'gameserver', 'serve', '--host', host, '--port', str(port)],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE)
+        server.stdout.readline()  # 等待 "serving on ..."
+    try:
+        run_load(host, port, clients, duration, plies)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m gameserver', description='asyncio JSON-lines game server')
+    commands = parser.add_subparsers(dest='command')
+    serve_parser = commands.add_parser('serve', help='host game sessions over TCP')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=7000)
+    serve_parser.add_argument('--max-sessions', type=int, default=100000)
+    bench_parser = commands.add_parser('bench', help='load-test a server and report latency percentiles')
+    bench_parser.add_argument('--host', default='127.0.0.1')
+    bench_parser.add_argument('--port', type=int, default=None, help='existing server (default: start one)')
+    bench_parser.add_argument('--clients', type=int, default=64)
+    bench_parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    bench_parser.add_argument('--plies', type=int, default=40, help='random plies per session')
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        serve(args.host, args.port, args.max_sessions)
+    elif args.command == 'bench':
+        bench(args.host, args.port, args.clients, args.duration, args.plies)
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())